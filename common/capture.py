@@ -0,0 +1,128 @@
+##################################################
+# 負荷試験（tools/replay.py）用に、受け取ったイベントを匿名化して記録する処理
+#
+# 利用する関数: dify_slack_bot_mention / dify_slack_bot_processor
+##################################################
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+# 記録先: 未設定（記録しない） / log（CloudWatch Logsに "CAPTURE " を付けて出力） / ファイルのパス
+CAPTURE = os.environ.get("CAPTURE", "")
+# 匿名化でIDをハッシュ化するときのソルト
+CAPTURE_SALT = os.environ.get("CAPTURE_SALT", "")
+
+LOG_PREFIX = "CAPTURE "
+
+# 記録しないヘッダー（署名や認証情報）
+_DROP_HEADERS = {"authorization", "x-slack-signature", "x-dify-secret-key"}
+# 記録しないSlackイベントのフィールド（トークンやワークスペースの情報）
+_DROP_FIELDS = {"token", "authorizations", "blocks", "team", "enterprise"}
+# 件数だけを残すフィールド（ファイル名・URL・添付の本文を含むため、中身は記録しない）
+_COUNTED_FIELDS = {"files", "attachments"}
+# 匿名化するIDのフィールド（IDのリストを含む）
+_ID_FIELDS = {
+    "user",
+    "user_id",
+    "channel",
+    "channel_id",
+    "team_id",
+    "api_app_id",
+    "bot_id",
+    "app_id",
+    "item_user",
+    "parent_user_id",
+    "authed_users",
+    "authed_teams",
+    "users",
+    "reply_users",
+    "user_team",
+    "source_team",
+}
+# "種類:ID" の形式でIDを含むフィールド（受付係が付ける fair_key など）
+_PREFIXED_ID_FIELDS = {"fair_key"}
+# 本文のフィールド（長さは負荷に影響するため残し、内容だけを伏せる）
+_TEXT_FIELDS = {"text", "question"}
+
+_lock = threading.Lock()
+
+
+def _pseudonym(value):
+    digest = hashlib.sha256((CAPTURE_SALT + str(value)).encode("utf-8")).hexdigest()
+    return f"{str(value)[:1]}{digest[:10].upper()}"
+
+
+def _redact_text(text):
+    # メンション（<@U123>）は匿名化したIDに置き換え、それ以外の文字は長さだけ残す
+    parts = re.split(r"(<@[A-Z0-9]+>)", text)
+    return "".join(
+        f"<@{_pseudonym(part[2:-1])}>" if part.startswith("<@") else "x" * len(part)
+        for part in parts
+    )
+
+
+def sanitize(value, key=None):
+    """
+    トークン・署名を取り除き、ID・本文を匿名化します（IDは同じ値が同じ仮名になる）。
+    ファイルと添付は件数（files_count / attachments_count）だけを残します。
+    """
+    if isinstance(value, dict):
+        result = {}
+        for k, v in value.items():
+            if k in _DROP_FIELDS or str(k).lower() in _DROP_HEADERS:
+                continue
+            if k in _COUNTED_FIELDS:
+                result[f"{k}_count"] = len(v) if isinstance(v, list) else 1
+                continue
+            result[k] = sanitize(v, k)
+        return result
+    if isinstance(value, list):
+        return [sanitize(v, key) for v in value]
+    if isinstance(value, str):
+        if key in _ID_FIELDS:
+            return _pseudonym(value)
+        if key in _PREFIXED_ID_FIELDS and ":" in value:
+            kind, id_ = value.split(":", 1)
+            return f"{kind}:{_pseudonym(id_)}"
+        if key in _TEXT_FIELDS:
+            return _redact_text(value)
+    return value
+
+
+def capture(kind, event):
+    """
+    イベントを記録します。記録に失敗しても本来の処理には影響させません。
+    kind は "apigw"（受付係が受け取ったリクエスト）または "sqs"（実行係が受け取ったレコード）です。
+    """
+    if not CAPTURE:
+        return
+    try:
+        if kind == "apigw":
+            event = dict(event)
+            body = json.loads(event.get("body") or "{}")
+            event["body"] = json.dumps(sanitize(body), ensure_ascii=False)
+            event["headers"] = sanitize(event.get("headers") or {})
+            event = {k: event[k] for k in ("body", "headers") if k in event}
+        elif kind == "sqs":
+            event = dict(event)
+            event["body"] = json.dumps(
+                sanitize(json.loads(event.get("body") or "{}")), ensure_ascii=False
+            )
+            event = {
+                k: event[k] for k in ("messageId", "body", "attributes") if k in event
+            }
+        line = json.dumps(
+            {"kind": kind, "captured_at": time.time(), "event": event},
+            ensure_ascii=False,
+        )
+        if CAPTURE == "log":
+            print(LOG_PREFIX + line)
+        else:
+            with _lock, open(CAPTURE, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+    except Exception as e:
+        print(f"Failed to capture event: {e}")
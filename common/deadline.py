@@ -0,0 +1,93 @@
+##################################################
+# Lambdaの残り実行時間から外部呼び出しのタイムアウトを決めるためのDeadline
+#
+# 利用する関数: get_messages / get_reactions / dify_authorizer / dify_slack_bot_mention / dify_slack_bot_processor
+##################################################
+
+import os
+import math
+import time
+
+# レスポンスの組み立てと返却のために残しておく時間（ミリ秒）
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", 2000))
+
+# boto3クライアントをタイムアウト（秒）ごとにキャッシュする
+_boto_clients = {}
+
+
+class Deadline:
+    """
+    ハンドラーの開始時に作成し、外部呼び出しのタイムアウトとして渡します。
+    ローカル実行などで context がない場合は期限なしとして扱います。
+    """
+
+    def __init__(self, remaining_ms=None, margin_ms=DEADLINE_MARGIN_MS):
+        self.margin_ms = margin_ms
+        if remaining_ms is None:
+            self.expires_at = None
+        else:
+            self.expires_at = time.monotonic() + (remaining_ms - margin_ms) / 1000
+
+    @classmethod
+    def from_context(cls, context, margin_ms=DEADLINE_MARGIN_MS):
+        get_remaining = getattr(context, "get_remaining_time_in_millis", None)
+        remaining_ms = get_remaining() if callable(get_remaining) else None
+        return cls(remaining_ms, margin_ms)
+
+    def remaining(self):
+        """残り時間（秒）。期限なしの場合は無限大"""
+        if self.expires_at is None:
+            return float("inf")
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    def lease_seconds(self):
+        """
+        この呼び出しが終わるまでの秒数（台帳のリース期間に使う）。
+        期限なしの場合は None を返し、台帳の既定のリース期間に任せます。
+        """
+        if self.expires_at is None:
+            return None
+        return max(int(math.ceil(self.remaining() + self.margin_ms / 1000)), 1)
+
+    def expired(self, reserve=0.0):
+        """残り時間が reserve 秒以下になったかどうか"""
+        return self.remaining() <= reserve
+
+    def timeout(self, cap, minimum=0.1, reserve=0.0):
+        """
+        外部呼び出しに渡すタイムアウト（秒）。
+        cap を上限とし、後続の処理のために reserve 秒を残します。
+        期限が迫っていても minimum 秒は確保します。
+        """
+        return max(min(self.remaining() - reserve, cap), minimum)
+
+    def sleep(self, seconds):
+        """
+        期限を超えない範囲で待機します。
+        待機後に時間が残っていない場合は False を返します。
+        """
+        time.sleep(min(seconds, self.remaining()))
+        return not self.expired()
+
+    def boto_client(self, service_name, cap=10, endpoint_url=None):
+        """
+        残り時間をタイムアウトに設定したboto3クライアントを返します。
+        クライアントの生成コストを抑えるため、秒単位で丸めてキャッシュします。
+        endpoint_url はS3互換ストレージなど、既定以外の接続先を使う場合に指定します。
+        """
+        import boto3
+        from botocore.config import Config
+
+        timeout = max(int(self.timeout(cap, minimum=1)), 1)
+        key = (service_name, timeout, endpoint_url)
+        if key not in _boto_clients:
+            _boto_clients[key] = boto3.client(
+                service_name,
+                endpoint_url=endpoint_url,
+                config=Config(
+                    connect_timeout=timeout,
+                    read_timeout=timeout,
+                    retries={"max_attempts": 2},
+                ),
+            )
+        return _boto_clients[key]
@@ -0,0 +1,187 @@
+##################################################
+# 取得結果をNDJSON形式でオブジェクトストレージに書き出す処理
+#
+# 利用する関数: get_messages / get_reactions
+##################################################
+
+import os
+import json
+import zlib
+import uuid
+from datetime import datetime, timezone
+
+from deadline import Deadline
+
+# 書き出し先: s3（S3互換ストレージ） / local（ローカルファイル、テスト用）
+EXPORT_BACKEND = os.environ.get("EXPORT_BACKEND", "s3")
+EXPORT_BUCKET = os.environ.get("EXPORT_BUCKET")
+EXPORT_PREFIX = os.environ.get("EXPORT_PREFIX", "exports")
+# MinIOなどS3互換ストレージを使う場合のエンドポイント
+EXPORT_S3_ENDPOINT_URL = os.environ.get("EXPORT_S3_ENDPOINT_URL")
+EXPORT_LOCAL_DIR = os.environ.get("EXPORT_LOCAL_DIR", "/tmp/exports")
+
+# マルチパートアップロードの1パートの大きさ（S3の最小は5MiB）
+S3_PART_SIZE = 8 * 1024 * 1024
+# S3 API呼び出し1回あたりのタイムアウト上限（秒）。実際にはLambdaの残り時間も考慮して決める
+S3_TIMEOUT_SECONDS = 30
+
+
+class LocalSink:
+    """
+    ローカルファイルに書き出す（テスト・ローカル実行用）
+    """
+
+    def __init__(self, key, base_dir=None):
+        self.path = os.path.join(base_dir or EXPORT_LOCAL_DIR, key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._file = open(self.path, "wb")
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        return f"file://{os.path.abspath(self.path)}"
+
+    def abort(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class S3Sink:
+    """
+    S3互換ストレージにマルチパートアップロードで書き出す
+    一定の大きさごとにパートとして送信するため、メモリに保持するのは1パート分のみ
+    各呼び出しのタイムアウトは deadline の残り時間に合わせ、Lambdaの終了前に失敗させる
+    """
+
+    def __init__(
+        self, key, bucket=None, content_type="application/x-ndjson", deadline=None
+    ):
+        self.bucket = bucket or EXPORT_BUCKET
+        if not self.bucket:
+            raise ValueError("EXPORT_BUCKET environment variable not set")
+        self.key = key
+        self.deadline = deadline or Deadline()
+        self._upload_id = self._client().create_multipart_upload(
+            Bucket=self.bucket, Key=key, ContentType=content_type
+        )["UploadId"]
+        self._parts = []
+        self._buffer = bytearray()
+
+    def _client(self):
+        return self.deadline.boto_client(
+            "s3", cap=S3_TIMEOUT_SECONDS, endpoint_url=EXPORT_S3_ENDPOINT_URL
+        )
+
+    def _flush(self):
+        part_number = len(self._parts) + 1
+        response = self._client().upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=bytes(self._buffer),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer.clear()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        if len(self._buffer) >= S3_PART_SIZE:
+            self._flush()
+
+    def close(self):
+        # 最後のパートは5MiB未満でもよい（空のオブジェクトでも1パートは必要）
+        if self._buffer or not self._parts:
+            self._flush()
+        self._client().complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+        return f"s3://{self.bucket}/{self.key}"
+
+    def abort(self):
+        self._client().abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+        )
+
+
+class NDJSONExporter:
+    """
+    レコードを1行1JSON（NDJSON）で書き出します。
+    compress=True の場合はgzip形式で圧縮しながら書き出します。
+
+    with 文で使うと、正常終了時に close()、例外発生時に abort() が呼ばれます。
+    """
+
+    def __init__(self, sink, compress=False):
+        self.sink = sink
+        self.compress = compress
+        self.record_count = 0
+        self.raw_bytes = 0
+        self.written_bytes = 0
+        self.pointer = None
+        # wbits=31 でgzipヘッダー付きの圧縮になる
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+
+    def _emit(self, data):
+        if data:
+            self.sink.write(data)
+            self.written_bytes += len(data)
+
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self.record_count += 1
+        self.raw_bytes += len(line)
+        self._emit(self._compressor.compress(line) if self._compressor else line)
+
+    def close(self):
+        if self._compressor:
+            self._emit(self._compressor.flush())
+        uri = self.sink.close()
+        self.pointer = {
+            "uri": uri,
+            "format": "ndjson",
+            "compression": "gzip" if self.compress else None,
+            "records": self.record_count,
+            "bytes": self.written_bytes,
+            "uncompressed_bytes": self.raw_bytes,
+        }
+        return self.pointer
+
+    def abort(self):
+        self.sink.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+
+def create_exporter(name, compress=False, backend=None, deadline=None):
+    """
+    環境変数の設定に従って書き出し先を作成します。
+    オブジェクトのキーは {EXPORT_PREFIX}/{name}/{日時}-{ランダム}.ndjson(.gz) になります。
+    deadline を指定すると、書き出し先への呼び出しのタイムアウトを残り時間に合わせます。
+    """
+    backend = (backend or EXPORT_BACKEND).lower()
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    suffix = ".ndjson.gz" if compress else ".ndjson"
+    key = f"{EXPORT_PREFIX}/{name}/{stamp}-{uuid.uuid4().hex[:8]}{suffix}"
+
+    if backend == "s3":
+        content_type = "application/gzip" if compress else "application/x-ndjson"
+        sink = S3Sink(key, content_type=content_type, deadline=deadline)
+    elif backend == "local":
+        sink = LocalSink(key)
+    else:
+        raise ValueError(f"Unknown export backend: {backend}")
+    return NDJSONExporter(sink, compress=compress)
@@ -0,0 +1,299 @@
+##################################################
+# Slackイベントの重複処理を防ぐための冪等性台帳
+#
+# 利用する関数: dify_slack_bot_mention / dify_slack_bot_processor
+##################################################
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+
+# 保存先: memory（ローカル・単一コンテナ向け） / sqlite（ローカル） / dynamodb（本番）
+IDEMPOTENCY_BACKEND = os.environ.get("IDEMPOTENCY_BACKEND", "memory")
+IDEMPOTENCY_DB_PATH = os.environ.get("IDEMPOTENCY_DB_PATH", "/tmp/idempotency.sqlite3")
+IDEMPOTENCY_TABLE_NAME = os.environ.get("IDEMPOTENCY_TABLE_NAME")
+
+# レコードの保持期間（秒）。Slackの再送やSQSの再配信が届く期間より長くする
+IDEMPOTENCY_TTL_SECONDS = int(os.environ.get("IDEMPOTENCY_TTL_SECONDS", 24 * 60 * 60))
+# 処理中レコードのリース期間（秒）。これを過ぎたら処理が落ちたとみなして再取得できる
+IDEMPOTENCY_LEASE_SECONDS = int(os.environ.get("IDEMPOTENCY_LEASE_SECONDS", 15 * 60))
+
+STATUS_IN_PROGRESS = "in_progress"
+STATUS_COMPLETED = "completed"
+STATUS_FAILED = "failed"
+
+
+class MemoryBackend:
+    """
+    プロセス内の辞書に保存するバックエンド（ローカル実行・テスト用）
+    """
+
+    # 複数のコンテナ（受付係と実行係を含む）から同じ台帳を参照できるかどうか
+    shared = False
+
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            record = self._records.get(key)
+            if record and record["expires_at"] <= now:
+                del self._records[key]
+                return None
+            return dict(record) if record else None
+
+    def put(self, key, record, expected_token, now):
+        """
+        expected_token が None の場合はレコードが存在しない（または期限切れ）ときのみ、
+        それ以外は現在のトークンが一致するときのみ書き込みます。
+        """
+        with self._lock:
+            current = self._records.get(key)
+            if current and current["expires_at"] <= now:
+                current = None
+            current_token = current["token"] if current else None
+            if current_token != expected_token:
+                return False
+            self._records[key] = dict(record)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+
+
+class SQLiteBackend:
+    """
+    SQLiteファイルに保存するバックエンド（ローカルで複数プロセスから共有する場合）
+    """
+
+    # 複数のコンテナ（受付係と実行係を含む）から同じ台帳を参照できるかどうか
+    shared = False
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS idempotency ("
+                " key TEXT PRIMARY KEY,"
+                " token TEXT NOT NULL,"
+                " record TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=10, isolation_level=None)
+
+    def get(self, key, now):
+        with self._lock, self._connect() as conn:
+            row = conn.execute(
+                "SELECT record FROM idempotency WHERE key = ? AND expires_at > ?",
+                (key, now),
+            ).fetchone()
+            return json.loads(row[0]) if row else None
+
+    def put(self, key, record, expected_token, now):
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT token FROM idempotency WHERE key = ? AND expires_at > ?",
+                    (key, now),
+                ).fetchone()
+                current_token = row[0] if row else None
+                if current_token != expected_token:
+                    conn.execute("ROLLBACK")
+                    return False
+                conn.execute(
+                    "INSERT OR REPLACE INTO idempotency (key, token, record, expires_at)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, record["token"], json.dumps(record), record["expires_at"]),
+                )
+                conn.execute("COMMIT")
+                return True
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, key):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+
+class DynamoDBBackend:
+    """
+    DynamoDBに保存するバックエンド（受付係と実行係で台帳を共有する本番用）
+    テーブルはパーティションキー "key"（文字列）、TTL属性 "expires_at" で作成してください。
+    """
+
+    # 複数のコンテナ（受付係と実行係を含む）から同じ台帳を参照できるかどうか
+    shared = True
+
+    def __init__(self, table_name):
+        import boto3
+
+        self._table = boto3.resource("dynamodb").Table(table_name)
+
+    def get(self, key, now):
+        item = self._table.get_item(Key={"key": key}, ConsistentRead=True).get("Item")
+        if not item or float(item["expires_at"]) <= now:
+            return None
+        return json.loads(item["record"])
+
+    def put(self, key, record, expected_token, now):
+        from botocore.exceptions import ClientError
+
+        if expected_token is None:
+            condition = "attribute_not_exists(#k) OR expires_at <= :now"
+            values = {":now": int(now)}
+        else:
+            condition = "#t = :token"
+            values = {":token": expected_token}
+        try:
+            self._table.put_item(
+                Item={
+                    "key": key,
+                    "token": record["token"],
+                    "record": json.dumps(record),
+                    "expires_at": int(record["expires_at"]),
+                },
+                ConditionExpression=condition,
+                ExpressionAttributeNames=(
+                    {"#k": "key"} if expected_token is None else {"#t": "token"}
+                ),
+                ExpressionAttributeValues=values,
+            )
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def delete(self, key):
+        self._table.delete_item(Key={"key": key})
+
+
+class IdempotencyLedger:
+    """
+    冪等性キー（Slackの event_id / client_msg_id など）ごとに処理状況を記録します。
+
+    claim() で処理権を取得し、成功したら complete()、失敗したら fail() を呼びます。
+    完了済みのキーは二度と取得できず、処理中のキーはリースが切れるまで取得できません。
+    失敗したキーは再送時に再取得でき、前回の試行で保存した data を引き継ぎます。
+    """
+
+    def __init__(self, backend, ttl_seconds=None, lease_seconds=None):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds or IDEMPOTENCY_TTL_SECONDS
+        self.lease_seconds = lease_seconds or IDEMPOTENCY_LEASE_SECONDS
+
+    def _write(self, key, status, data, expected_token, now, lease_seconds=0):
+        record = {
+            "token": uuid.uuid4().hex,
+            "status": status,
+            "data": data or {},
+            "lease_expires_at": now + lease_seconds,
+            "expires_at": now + self.ttl_seconds,
+        }
+        if self.backend.put(key, record, expected_token, now):
+            return record
+        return None
+
+    @property
+    def shared(self):
+        """
+        コンテナをまたいで重複を判定できるかどうか。
+        memory / sqlite はコンテナごとの台帳のため、別のコンテナに届いた再送は判定できない。
+        """
+        return self.backend.shared
+
+    def get(self, key):
+        return self.backend.get(key, time.time())
+
+    def claim(self, key, lease_seconds=None):
+        """
+        処理権の取得を試みます。
+        戻り値は (取得できたか, レコード) のタプルです。
+        取得できなかった場合のレコードは、先行する処理の状態を表します。
+        """
+        now = time.time()
+        lease_seconds = lease_seconds or self.lease_seconds
+        current = self.backend.get(key, now)
+
+        if current is None:
+            record = self._write(key, STATUS_IN_PROGRESS, {}, None, now, lease_seconds)
+            if record:
+                return True, record
+            return False, self.backend.get(key, now)
+
+        if current["status"] == STATUS_COMPLETED:
+            return False, current
+        if (
+            current["status"] == STATUS_IN_PROGRESS
+            and current["lease_expires_at"] > now
+        ):
+            return False, current
+
+        # 失敗した、またはリースが切れた処理を引き継ぐ
+        record = self._write(
+            key,
+            STATUS_IN_PROGRESS,
+            current.get("data"),
+            current["token"],
+            now,
+            lease_seconds,
+        )
+        if record:
+            return True, record
+        return False, self.backend.get(key, now)
+
+    def save(self, key, record, **data):
+        """
+        処理中のレコードに途中経過（投稿したメッセージのtsなど）を保存します。
+        """
+        now = time.time()
+        merged = dict(record.get("data") or {}, **data)
+        lease_seconds = max(record["lease_expires_at"] - now, 0)
+        updated = self._write(
+            key, record["status"], merged, record["token"], now, lease_seconds
+        )
+        return updated or record
+
+    def complete(self, key, record, **data):
+        now = time.time()
+        merged = dict(record.get("data") or {}, **data)
+        return self._write(key, STATUS_COMPLETED, merged, record["token"], now)
+
+    def fail(self, key, record, **data):
+        now = time.time()
+        merged = dict(record.get("data") or {}, **data)
+        return self._write(key, STATUS_FAILED, merged, record["token"], now)
+
+    def release(self, key):
+        """
+        レコードを削除し、同じキーをすぐに再取得できるようにします（同時実行数の枠などに使う）。
+        """
+        self.backend.delete(key)
+
+
+def create_ledger(backend_name=None):
+    """
+    環境変数の設定に従って台帳を作成します。
+    """
+    backend_name = (backend_name or IDEMPOTENCY_BACKEND).lower()
+    if backend_name == "sqlite":
+        backend = SQLiteBackend(IDEMPOTENCY_DB_PATH)
+    elif backend_name == "dynamodb":
+        if not IDEMPOTENCY_TABLE_NAME:
+            raise ValueError("IDEMPOTENCY_TABLE_NAME environment variable not set")
+        backend = DynamoDBBackend(IDEMPOTENCY_TABLE_NAME)
+    elif backend_name == "memory":
+        backend = MemoryBackend()
+    else:
+        raise ValueError(f"Unknown idempotency backend: {backend_name}")
+    return IdempotencyLedger(backend)
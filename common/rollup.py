@@ -0,0 +1,424 @@
+##################################################
+# チャンネルの活動量（メッセージ数・リアクション数）を1時間単位で集計・保存する処理
+#
+# 利用する関数: get_messages / get_reactions
+##################################################
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# 保存先: sqlite（ローカル） / dynamodb（本番で複数の関数から共有する場合） / memory / none
+ROLLUP_BACKEND = os.environ.get("ROLLUP_BACKEND", "sqlite")
+ROLLUP_DB_PATH = os.environ.get("ROLLUP_DB_PATH", "/tmp/rollups.sqlite3")
+ROLLUP_TABLE_NAME = os.environ.get("ROLLUP_TABLE_NAME")
+
+HOUR_SECONDS = 60 * 60
+# リアクションはメッセージの投稿後も増えるため、1時間が終わってからこの時間が経つまでは集計を保存しない
+ROLLUP_SETTLE_SECONDS = int(
+    float(os.environ.get("ROLLUP_SETTLE_HOURS", 24)) * HOUR_SECONDS
+)
+# 1時間あたりに保持する、リアクションの多いメッセージの件数
+TOP_MESSAGES = 5
+# 集計結果で返す上位ユーザー数
+TOP_CONTRIBUTORS = 10
+
+
+def hour_of(ts):
+    """タイムスタンプが属する1時間の開始時刻（Unix秒）"""
+    return int(float(ts) // HOUR_SECONDS * HOUR_SECONDS)
+
+
+def empty_rollup():
+    return {
+        "message_count": 0,
+        "reaction_count": 0,
+        "messages_by_user": {},
+        "reactions_received": {},
+        "reactions_given": {},
+        "reactions_by_name": {},
+        "top_messages": [],
+    }
+
+
+def _add_counts(target, source):
+    for key, count in source.items():
+        target[key] = target.get(key, 0) + count
+
+
+def _top(messages, n):
+    return sorted(messages, key=lambda m: (-m["reaction_count"], m["ts"]))[:n]
+
+
+def merge_rollups(rollups, top_n=TOP_MESSAGES):
+    """
+    複数の集計結果（1時間ごと）を1つにまとめます。
+    """
+    merged = empty_rollup()
+    top_messages = []
+    for rollup in rollups:
+        merged["message_count"] += rollup["message_count"]
+        merged["reaction_count"] += rollup["reaction_count"]
+        for key in (
+            "messages_by_user",
+            "reactions_received",
+            "reactions_given",
+            "reactions_by_name",
+        ):
+            _add_counts(merged[key], rollup[key])
+        top_messages.extend(rollup["top_messages"])
+    merged["top_messages"] = _top(top_messages, top_n)
+    return merged
+
+
+class HourlyRollupBuilder:
+    """
+    conversations.history から取得したメッセージを1件ずつ受け取り、1時間ごとに集計します。
+    メッセージ自体は保持しないため、メモリ使用量は期間（時間数）にのみ比例します。
+    """
+
+    def __init__(self, top_n=TOP_MESSAGES):
+        self.top_n = top_n
+        self.hours = {}
+
+    def add(self, message):
+        rollup = self.hours.setdefault(hour_of(message["ts"]), empty_rollup())
+        user_id = message.get("user", "unknown")
+        rollup["message_count"] += 1
+        _add_counts(rollup["messages_by_user"], {user_id: 1})
+
+        received = 0
+        for reaction in message.get("reactions", []):
+            users = reaction.get("users", [])
+            received += len(users)
+            _add_counts(rollup["reactions_by_name"], {reaction["name"]: len(users)})
+            for reactor in users:
+                _add_counts(rollup["reactions_given"], {reactor: 1})
+        if received:
+            rollup["reaction_count"] += received
+            _add_counts(rollup["reactions_received"], {user_id: received})
+            rollup["top_messages"].append(
+                {
+                    "ts": message["ts"],
+                    "user_id": user_id,
+                    "text": message.get("text", "")[:200],
+                    "reaction_count": received,
+                }
+            )
+            # 上位だけを残して、保持する件数を抑える
+            if len(rollup["top_messages"]) > self.top_n * 2:
+                rollup["top_messages"] = _top(rollup["top_messages"], self.top_n)
+
+    def rollups(self, hours=None):
+        """
+        1時間ごとの集計結果を返します。hours を指定した場合、メッセージがない時間も空の集計として含めます。
+        """
+        hours = self.hours.keys() if hours is None else hours
+        result = {}
+        for hour in hours:
+            rollup = self.hours.get(hour) or empty_rollup()
+            rollup["top_messages"] = _top(rollup["top_messages"], self.top_n)
+            result[hour] = rollup
+        return result
+
+
+class MemoryRollupStore:
+    """
+    プロセス内の辞書に保存する（テスト用）
+    各ストアの get_hours は、保存した集計に集計時刻（computed_at）を加えて返します。
+    """
+
+    def __init__(self):
+        self._rollups = {}
+        self._lock = threading.Lock()
+
+    def get_hours(self, channel_id, hours):
+        with self._lock:
+            return {
+                hour: dict(self._rollups[(channel_id, hour)])
+                for hour in hours
+                if (channel_id, hour) in self._rollups
+            }
+
+    def put_hours(self, channel_id, rollups):
+        now = time.time()
+        with self._lock:
+            for hour, rollup in rollups.items():
+                self._rollups[(channel_id, hour)] = dict(rollup, computed_at=now)
+
+
+class SQLiteRollupStore:
+    """
+    SQLiteファイルに保存する（ローカル実行用）
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hourly_rollups ("
+                " channel_id TEXT NOT NULL,"
+                " hour_start INTEGER NOT NULL,"
+                " rollup TEXT NOT NULL,"
+                " computed_at REAL NOT NULL,"
+                " PRIMARY KEY (channel_id, hour_start))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self._path, timeout=10)
+
+    def get_hours(self, channel_id, hours):
+        hours = list(hours)
+        if not hours:
+            return {}
+        with self._lock, self._connect() as conn:
+            rows = conn.execute(
+                "SELECT hour_start, rollup, computed_at FROM hourly_rollups"
+                " WHERE channel_id = ? AND hour_start BETWEEN ? AND ?",
+                (channel_id, min(hours), max(hours)),
+            ).fetchall()
+        wanted = set(hours)
+        return {
+            hour: dict(json.loads(data), computed_at=computed_at)
+            for hour, data, computed_at in rows
+            if hour in wanted
+        }
+
+    def put_hours(self, channel_id, rollups):
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO hourly_rollups"
+                " (channel_id, hour_start, rollup, computed_at) VALUES (?, ?, ?, ?)",
+                [
+                    (channel_id, hour, json.dumps(rollup, ensure_ascii=False), now)
+                    for hour, rollup in rollups.items()
+                ],
+            )
+
+
+class DynamoDBRollupStore:
+    """
+    DynamoDBに保存する（get_messages と get_reactions で共有する本番用）
+    テーブルはパーティションキー "channel_id"（文字列）、ソートキー "hour_start"（数値）で作成してください。
+    """
+
+    def __init__(self, table_name):
+        import boto3
+
+        self._table = boto3.resource("dynamodb").Table(table_name)
+
+    def get_hours(self, channel_id, hours):
+        from boto3.dynamodb.conditions import Key
+
+        hours = list(hours)
+        if not hours:
+            return {}
+        wanted = set(hours)
+        result = {}
+        kwargs = {
+            "KeyConditionExpression": Key("channel_id").eq(channel_id)
+            & Key("hour_start").between(min(hours), max(hours))
+        }
+        while True:
+            response = self._table.query(**kwargs)
+            for item in response.get("Items", []):
+                hour = int(item["hour_start"])
+                if hour in wanted:
+                    result[hour] = dict(
+                        json.loads(item["rollup"]),
+                        computed_at=float(item.get("computed_at", 0)),
+                    )
+            if "LastEvaluatedKey" not in response:
+                return result
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def put_hours(self, channel_id, rollups):
+        now = int(time.time())
+        with self._table.batch_writer() as batch:
+            for hour, rollup in rollups.items():
+                batch.put_item(
+                    Item={
+                        "channel_id": channel_id,
+                        "hour_start": hour,
+                        "rollup": json.dumps(rollup, ensure_ascii=False),
+                        "computed_at": now,
+                    }
+                )
+
+
+def create_rollup_store(backend=None):
+    """
+    環境変数の設定に従って保存先を作成します。"none" の場合は None を返します。
+    """
+    backend = (backend or ROLLUP_BACKEND).lower()
+    if backend == "none":
+        return None
+    if backend == "sqlite":
+        return SQLiteRollupStore(ROLLUP_DB_PATH)
+    if backend == "dynamodb":
+        if not ROLLUP_TABLE_NAME:
+            raise ValueError("ROLLUP_TABLE_NAME environment variable not set")
+        return DynamoDBRollupStore(ROLLUP_TABLE_NAME)
+    if backend == "memory":
+        return MemoryRollupStore()
+    raise ValueError(f"Unknown rollup backend: {backend}")
+
+
+def closed_hours(oldest_ts, latest_ts, now=None, settle_seconds=0):
+    """
+    [oldest_ts, latest_ts] に完全に含まれ、終わってから settle_seconds 秒以上経った
+    1時間の開始時刻の一覧
+    """
+    now = time.time() if now is None else now
+    first = hour_of(oldest_ts)
+    if first < oldest_ts:
+        first += HOUR_SECONDS
+    end = min(latest_ts, now - settle_seconds)
+    return list(range(first, int(end) - HOUR_SECONDS + 1, HOUR_SECONDS))
+
+
+def save_scanned_rollups(
+    store,
+    channel_id,
+    builder,
+    oldest_ts,
+    latest_ts,
+    now=None,
+    settle_seconds=ROLLUP_SETTLE_SECONDS,
+):
+    """
+    通常の取得処理で期間内のメッセージをすべて走査した場合に、
+    完全に含まれ、リアクションの増減が落ち着いた時間の集計を保存します（追加のAPI呼び出しは不要）。
+    """
+    hours = closed_hours(oldest_ts, latest_ts, now=now, settle_seconds=settle_seconds)
+    if store is not None and hours:
+        store.put_hours(channel_id, builder.rollups(hours))
+    return len(hours)
+
+
+def _runs(hours):
+    """連続する時間ごとにまとめる（1回の走査で取得できるように）"""
+    runs = []
+    for hour in sorted(hours):
+        if runs and runs[-1][-1] + HOUR_SECONDS == hour:
+            runs[-1].append(hour)
+        else:
+            runs.append([hour])
+    return runs
+
+
+def query_rollups(
+    store,
+    channel_id,
+    oldest_ts,
+    latest_ts,
+    scan,
+    now=None,
+    settle_seconds=ROLLUP_SETTLE_SECONDS,
+):
+    """
+    期間内の集計を、保存済みの1時間ごとの集計を組み合わせて求めます。
+
+    保存されていない終了済みの時間は scan で取得して集計・保存し、
+    まだ終わっていない現在の時間だけは毎回取得し直します（保存しません）。
+    終わってから settle_seconds 秒が経っていない時間は、後からリアクションが増えるため
+    毎回集計し直し、保存しません。保存済みでも、その前に集計したものは集計し直します。
+    期間は1時間単位に広げて扱います。
+
+    scan(oldest_ts, latest_ts) は (メッセージのイテレータ, 打ち切られたかどうかを返す関数) を返します。
+    途中で打ち切られた時間の集計は保存しません。
+    """
+    now = time.time() if now is None else now
+    latest_ts = min(latest_ts, now)
+    hours = list(range(hour_of(oldest_ts), hour_of(latest_ts) + 1, HOUR_SECONDS))
+    open_hour = hour_of(now)
+    done = [hour for hour in hours if hour != open_hour]
+
+    def settled_at(hour):
+        return hour + HOUR_SECONDS + settle_seconds
+
+    settled = [hour for hour in done if settled_at(hour) <= now]
+    cached = store.get_hours(channel_id, settled) if store is not None else {}
+    rollups = {
+        hour: rollup
+        for hour, rollup in cached.items()
+        if rollup.get("computed_at", 0) >= settled_at(hour)
+    }
+    stats = {
+        "hours": len(hours),
+        "cached_hours": len(rollups),
+        "computed_hours": 0,
+        "live_hours": 0,
+    }
+    truncated = False
+
+    def compute(hour_list, end_ts):
+        # 境界ちょうどのメッセージは両側の走査に含まれるため、対象の時間のみ集計する
+        wanted = set(hour_list)
+        builder = HourlyRollupBuilder()
+        messages, is_truncated = scan(hour_list[0], end_ts)
+        for message in messages:
+            if hour_of(message["ts"]) in wanted:
+                builder.add(message)
+        return builder.rollups(hour_list), is_truncated()
+
+    for run in _runs(hour for hour in done if hour not in rollups):
+        computed, is_truncated = compute(run, run[-1] + HOUR_SECONDS)
+        rollups.update(computed)
+        stats["computed_hours"] += len(run)
+        if is_truncated:
+            truncated = True
+            break
+        if store is not None:
+            store.put_hours(
+                channel_id,
+                {
+                    hour: rollup
+                    for hour, rollup in computed.items()
+                    if settled_at(hour) <= now
+                },
+            )
+
+    if open_hour in hours and not truncated:
+        live, is_truncated = compute([open_hour], now)
+        rollups.update(live)
+        stats["live_hours"] = 1
+        truncated = truncated or is_truncated
+
+    merged = merge_rollups(rollups.values())
+    top_contributors = sorted(
+        merged["messages_by_user"].items(), key=lambda item: (-item[1], item[0])
+    )[:TOP_CONTRIBUTORS]
+    merged["top_contributors"] = [
+        {
+            "user_id": user_id,
+            "message_count": count,
+            "reactions_received": merged["reactions_received"].get(user_id, 0),
+        }
+        for user_id, count in top_contributors
+    ]
+    merged["cache"] = stats
+    merged["truncated"] = truncated
+    return merged
+
+
+def query_recent_rollups(store, scanner, channel_id, minutes, shards=1):
+    """
+    直近 minutes 分の集計を返します。不足している時間は scanner（HistoryScanner）で取得します。
+    """
+    now = time.time()
+
+    def scan(oldest_ts, latest_ts):
+        return (
+            scanner.scan(oldest_ts, latest_ts, shards=shards),
+            lambda: scanner.truncated,
+        )
+
+    summary = query_rollups(store, channel_id, now - minutes * 60, now, scan, now=now)
+    summary["channel_id"] = channel_id
+    summary["minutes"] = minutes
+    return summary
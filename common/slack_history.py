@@ -0,0 +1,211 @@
+##################################################
+# conversations.history を期間（時間帯）ごとに分割して並列に取得する処理
+#
+# 利用する関数: get_messages / get_reactions
+##################################################
+
+import math
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from slack_sdk import WebClient
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+
+from deadline import Deadline
+
+# 1回のAPI呼び出しで取得するメッセージ数の上限（Slack APIの上限は999、推奨は200）
+HISTORY_PAGE_LIMIT = 200
+# 並列に取得するシャード数の上限（conversations.history は Tier3: 50+ req/min）
+MAX_SHARDS = 8
+# シャード数を自動で決める場合の、1シャードあたりの目安のメッセージ数
+MESSAGES_PER_SHARD = 1000
+# Slack API呼び出し1回あたりのタイムアウト上限（秒）
+SLACK_TIMEOUT_SECONDS = 30
+
+
+def _format_ts(ts):
+    return f"{ts:.6f}"
+
+
+def split_window(oldest_ts, latest_ts, shards):
+    """
+    [oldest_ts, latest_ts] を shards 個の連続した期間に分割します。
+    新しい期間から順に返します（conversations.history の返却順に合わせる）。
+    """
+    shards = max(int(shards), 1)
+    width = (latest_ts - oldest_ts) / shards
+    bounds = [oldest_ts + width * i for i in range(shards)] + [latest_ts]
+    return [(bounds[i], bounds[i + 1]) for i in reversed(range(shards))]
+
+
+class HistoryScanner:
+    """
+    指定した期間のメッセージを conversations.history から取得します。
+
+    shards に 2 以上を指定すると期間を分割し、それぞれのカーソルを並列にたどります。
+    "auto" の場合は最初の1ページからメッセージの密度を見積もって分割数を決めます。
+    分割の境界にあるメッセージは両側から取得されるため、ts で重複を除きます。
+    期限が迫った場合は取得を打ち切り、truncated を True にします。
+    reserve を指定すると、取得したメッセージの後処理のためにその秒数を残して打ち切ります。
+    """
+
+    def __init__(
+        self, token, channel_id, deadline=None, max_shards=MAX_SHARDS, reserve=0.0
+    ):
+        self.token = token
+        self.channel_id = channel_id
+        self.deadline = deadline or Deadline()
+        self.reserve = reserve
+        self.max_shards = max(int(max_shards), 1)
+        self.truncated = False
+        self.shard_count = 1
+        self.page_count = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _client(self):
+        # レートリミット（HTTP 429）の場合は Retry-After に従って再試行する
+        return WebClient(
+            token=self.token,
+            timeout=self.deadline.timeout(SLACK_TIMEOUT_SECONDS, reserve=self.reserve),
+            retry_handlers=[RateLimitErrorRetryHandler(max_retry_count=2)],
+        )
+
+    def _pages(self, client, oldest_ts, latest_ts, cursor=None):
+        """
+        1つの期間についてカーソルをたどり、ページ（メッセージのリスト）を順に返します。
+        タイムアウトなどの通信エラーの場合は、取得済みのページを活かすために打ち切りとして扱います。
+        """
+        while not self._stop.is_set():
+            if self.deadline.expired(reserve=self.reserve):
+                self.truncated = True
+                return
+            client.timeout = self.deadline.timeout(
+                SLACK_TIMEOUT_SECONDS, reserve=self.reserve
+            )
+            try:
+                response = client.conversations_history(
+                    channel=self.channel_id,
+                    oldest=_format_ts(oldest_ts),
+                    latest=_format_ts(latest_ts),
+                    inclusive=True,
+                    limit=HISTORY_PAGE_LIMIT,
+                    cursor=cursor,
+                )
+            except OSError as e:
+                # socket.timeout / URLError など
+                print(f"⚠️ 履歴の取得を打ち切ります: {e}")
+                self.truncated = True
+                return
+            with self._lock:
+                self.page_count += 1
+            yield response.get("messages", []), response.get("has_more", False)
+
+            cursor = (response.get("response_metadata") or {}).get("next_cursor")
+            if not response.get("has_more") or not cursor:
+                return
+
+    def estimate_shards(self, page, has_more, oldest_ts, latest_ts):
+        """
+        最初のページに含まれるメッセージの時間幅から、期間全体のメッセージ数を見積もって
+        シャード数を決めます。
+        """
+        if not has_more or not page:
+            return 1
+        page_oldest = min(float(m["ts"]) for m in page)
+        span = max(latest_ts - page_oldest, 1.0)
+        estimated = len(page) / span * (latest_ts - oldest_ts)
+        return min(max(math.ceil(estimated / MESSAGES_PER_SHARD), 1), self.max_shards)
+
+    def _scan_shards(self, windows):
+        """
+        各期間をスレッドで並列に取得し、取得できたページから順に返します。
+        呼び出し側の処理が遅い場合でも取得済みのページがメモリにたまらないように、
+        キューの大きさを制限し、空きができるまで次のページの取得を待ちます。
+        """
+        pages = queue.Queue(maxsize=2 * len(windows))
+        done = object()
+
+        def put(item):
+            # 呼び出し側がやめた場合は、キューの空きを待たずに終了する
+            while not self._stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def worker(window):
+            try:
+                for page, _ in self._pages(self._client(), *window):
+                    if not put(page):
+                        return
+            except OSError as e:
+                print(f"⚠️ 履歴の取得を打ち切ります: {e}")
+                self.truncated = True
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        with ThreadPoolExecutor(max_workers=len(windows)) as executor:
+            for window in windows:
+                executor.submit(worker, window)
+            remaining = len(windows)
+            try:
+                while remaining:
+                    item = pages.get()
+                    if item is done:
+                        remaining -= 1
+                    elif isinstance(item, Exception):
+                        raise item
+                    else:
+                        yield item
+            finally:
+                # 呼び出し側が途中でやめた場合やエラー時は、残りのスレッドも止める
+                self._stop.set()
+
+    def scan(self, oldest_ts, latest_ts, shards=1):
+        """
+        期間内のメッセージを1件ずつ返します（ts で重複を除いたもの）。
+        シャードを使う場合、返却順は ts の順になりません。
+        """
+        self._stop.clear()
+        seen = set()
+
+        def unique(page):
+            for message in page:
+                ts = message.get("ts")
+                if ts in seen:
+                    continue
+                seen.add(ts)
+                yield message
+
+        if shards == "auto":
+            # 最初の1ページで密度を見積もり、残りの期間を分割する
+            first_pages = self._pages(self._client(), oldest_ts, latest_ts)
+            page, has_more = next(first_pages, ([], False))
+            yield from unique(page)
+            shards = self.estimate_shards(page, has_more, oldest_ts, latest_ts)
+            if not has_more:
+                return
+            if shards == 1:
+                # 分割するほど多くない場合は、そのままカーソルをたどる
+                for page, _ in first_pages:
+                    yield from unique(page)
+                return
+            first_pages.close()
+            latest_ts = min(float(m["ts"]) for m in page)
+
+        self.shard_count = min(max(int(shards), 1), self.max_shards)
+        print(f"📜 {self.shard_count}シャードで履歴を取得します。")
+        if self.shard_count == 1:
+            for page, _ in self._pages(self._client(), oldest_ts, latest_ts):
+                yield from unique(page)
+            return
+
+        windows = split_window(oldest_ts, latest_ts, self.shard_count)
+        for page in self._scan_shards(windows):
+            yield from unique(page)
@@ -0,0 +1,78 @@
+import json
+
+import capture
+from capture import sanitize
+
+
+def test_files_and_attachments_keep_only_counts():
+    event = {
+        "event": {
+            "text": "<@U1> see this",
+            "files": [
+                {
+                    "name": "salary_2026.xlsx",
+                    "title": "Salary 2026",
+                    "url_private": "https://acme-corp.slack.com/files/U2/F1/salary_2026.xlsx",
+                },
+                {"name": "notes.txt"},
+            ],
+            "attachments": [{"fallback": "confidential roadmap", "text": "roadmap"}],
+        }
+    }
+
+    sanitized = sanitize(event)["event"]
+    assert "files" not in sanitized
+    assert "attachments" not in sanitized
+    assert sanitized["files_count"] == 2
+    assert sanitized["attachments_count"] == 1
+
+    dumped = json.dumps(sanitized)
+    for secret in ("salary", "acme-corp", "U2", "confidential", "roadmap"):
+        assert secret not in dumped
+
+
+def test_ids_are_pseudonymized_consistently():
+    sanitized = sanitize(
+        {
+            "user": "U1",
+            "authed_users": ["U1", "U2"],
+            "fair_key": "user:U1",
+            "channel": "C1",
+        }
+    )
+    pseudonym = sanitized["user"]
+    assert pseudonym != "U1"
+    assert sanitized["authed_users"][0] == pseudonym
+    assert sanitized["fair_key"] == f"user:{pseudonym}"
+    assert sanitized["channel"] != "C1"
+
+
+def test_text_keeps_length_and_mentions():
+    sanitized = sanitize({"text": "<@U1> hello"})
+    text = sanitized["text"]
+    assert text.endswith("x" * 6)
+    assert len(text) == len(f"<@{sanitize({'user': 'U1'})['user']}>") + 6
+
+
+def test_tokens_and_signatures_are_dropped():
+    sanitized = sanitize(
+        {"token": "secret", "X-Slack-Signature": "v0=abc", "event_id": "Ev1"}
+    )
+    assert sanitized == {"event_id": "Ev1"}
+
+
+def test_capture_writes_sanitized_sqs_record(tmp_path, monkeypatch):
+    path = tmp_path / "capture.ndjson"
+    monkeypatch.setattr(capture, "CAPTURE", str(path))
+    body = {"question": "secret?", "user_id": "U1", "files": [{"name": "a.pdf"}]}
+    capture.capture(
+        "sqs", {"messageId": "m1", "body": json.dumps(body), "receiptHandle": "rh"}
+    )
+
+    record = json.loads(path.read_text())
+    assert record["kind"] == "sqs"
+    assert set(record["event"]) == {"messageId", "body"}
+    captured = json.loads(record["event"]["body"])
+    assert captured["question"] == "xxxxxxx"
+    assert captured["files_count"] == 1
+    assert captured["user_id"] != "U1"
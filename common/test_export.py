@@ -0,0 +1,139 @@
+import gzip
+import json
+
+import pytest
+
+import export
+from deadline import Deadline
+from export import LocalSink, NDJSONExporter, S3Sink, create_exporter
+
+
+class FakeS3:
+    def __init__(self):
+        self.parts = []
+        self.completed = None
+        self.aborted = False
+
+    def create_multipart_upload(self, Bucket, Key, ContentType):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts.append((PartNumber, Body))
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload["Parts"]
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+
+@pytest.fixture
+def fake_s3(monkeypatch):
+    s3 = FakeS3()
+    calls = []
+
+    def boto_client(deadline, service_name, cap=10, endpoint_url=None):
+        calls.append((service_name, deadline.timeout(cap, minimum=1)))
+        return s3
+
+    monkeypatch.setattr(Deadline, "boto_client", boto_client)
+    s3.calls = calls
+    return s3
+
+
+def records(n):
+    return [{"ts": f"{i}.000000", "text": "こんにちは" * (i % 5)} for i in range(n)]
+
+
+def read_lines(data):
+    return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+
+def test_local_export_writes_one_json_per_line(tmp_path):
+    exporter = NDJSONExporter(LocalSink("messages/out.ndjson", base_dir=tmp_path))
+    with exporter:
+        for record in records(3):
+            exporter.write(record)
+
+    path = tmp_path / "messages" / "out.ndjson"
+    assert read_lines(path.read_bytes()) == records(3)
+    assert exporter.pointer["uri"] == f"file://{path}"
+    assert exporter.pointer["records"] == 3
+    assert exporter.pointer["bytes"] == exporter.pointer["uncompressed_bytes"]
+    assert exporter.pointer["compression"] is None
+
+
+def test_gzip_export_is_a_valid_gzip_stream(tmp_path):
+    exporter = NDJSONExporter(
+        LocalSink("out.ndjson.gz", base_dir=tmp_path), compress=True
+    )
+    with exporter:
+        for record in records(500):
+            exporter.write(record)
+
+    data = (tmp_path / "out.ndjson.gz").read_bytes()
+    assert read_lines(gzip.decompress(data)) == records(500)
+    assert exporter.pointer["bytes"] == len(data)
+    assert exporter.pointer["bytes"] < exporter.pointer["uncompressed_bytes"]
+
+
+def test_empty_gzip_export_is_still_valid(tmp_path):
+    exporter = NDJSONExporter(LocalSink("empty.ndjson.gz", base_dir=tmp_path), True)
+    with exporter:
+        pass
+
+    assert gzip.decompress((tmp_path / "empty.ndjson.gz").read_bytes()) == b""
+    assert exporter.pointer["records"] == 0
+
+
+def test_exception_aborts_and_removes_partial_file(tmp_path):
+    with pytest.raises(RuntimeError):
+        with NDJSONExporter(LocalSink("out.ndjson", base_dir=tmp_path)) as exporter:
+            exporter.write({"ts": "1.000000"})
+            raise RuntimeError("scan failed")
+
+    assert not (tmp_path / "out.ndjson").exists()
+    assert exporter.pointer is None
+
+
+def test_s3_sink_uploads_full_parts_and_last_part(fake_s3, monkeypatch):
+    monkeypatch.setattr(export, "S3_PART_SIZE", 10)
+    sink = S3Sink("key", bucket="bucket")
+    sink.write(b"x" * 12)
+    sink.write(b"y" * 3)
+
+    assert sink.close() == "s3://bucket/key"
+    assert [body for _, body in fake_s3.parts] == [b"x" * 12, b"y" * 3]
+    assert fake_s3.completed == [
+        {"ETag": "etag-1", "PartNumber": 1},
+        {"ETag": "etag-2", "PartNumber": 2},
+    ]
+
+
+def test_s3_sink_uploads_one_empty_part_for_empty_export(fake_s3):
+    sink = S3Sink("key", bucket="bucket")
+    sink.close()
+    assert fake_s3.parts == [(1, b"")]
+    assert fake_s3.completed == [{"ETag": "etag-1", "PartNumber": 1}]
+
+
+def test_s3_sink_abort_cancels_multipart_upload(fake_s3):
+    sink = S3Sink("key", bucket="bucket")
+    sink.write(b"data")
+    sink.abort()
+    assert fake_s3.aborted
+    assert fake_s3.completed is None
+
+
+def test_s3_calls_use_the_deadline_for_timeouts(fake_s3, monkeypatch):
+    monkeypatch.setattr(export, "EXPORT_BUCKET", "bucket")
+    exporter = create_exporter(
+        "messages/C1", backend="s3", deadline=Deadline(5_000, margin_ms=0)
+    )
+    with exporter:
+        exporter.write({"ts": "1.000000"})
+
+    assert exporter.pointer["uri"].startswith("s3://bucket/exports/messages/C1/")
+    assert fake_s3.calls
+    assert all(name == "s3" and timeout <= 5 for name, timeout in fake_s3.calls)
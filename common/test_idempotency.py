@@ -0,0 +1,117 @@
+import pytest
+
+import idempotency
+from idempotency import (
+    STATUS_COMPLETED,
+    STATUS_FAILED,
+    STATUS_IN_PROGRESS,
+    IdempotencyLedger,
+    MemoryBackend,
+    SQLiteBackend,
+)
+
+
+class Clock:
+    def __init__(self, now=1_700_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(idempotency.time, "time", clock)
+    return clock
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def ledger(request, tmp_path):
+    if request.param == "memory":
+        backend = MemoryBackend()
+    else:
+        backend = SQLiteBackend(str(tmp_path / "idempotency.sqlite3"))
+    return IdempotencyLedger(backend, ttl_seconds=3600, lease_seconds=60)
+
+
+def test_claim_is_exclusive_while_in_progress(ledger, clock):
+    acquired, record = ledger.claim("event:1")
+    assert acquired
+    assert record["status"] == STATUS_IN_PROGRESS
+
+    acquired, current = ledger.claim("event:1")
+    assert not acquired
+    assert current["token"] == record["token"]
+
+
+def test_completed_key_is_never_claimed_again(ledger, clock):
+    _, record = ledger.claim("event:1")
+    ledger.complete("event:1", record)
+
+    clock.now += 120
+    acquired, current = ledger.claim("event:1")
+    assert not acquired
+    assert current["status"] == STATUS_COMPLETED
+
+
+def test_failed_key_is_reclaimed_with_saved_data(ledger, clock):
+    _, record = ledger.claim("event:1")
+    record = ledger.save("event:1", record, message_ts="1.000100")
+    ledger.fail("event:1", record)
+
+    acquired, retried = ledger.claim("event:1")
+    assert acquired
+    assert retried["status"] == STATUS_IN_PROGRESS
+    assert retried["data"] == {"message_ts": "1.000100"}
+
+
+def test_expired_lease_is_taken_over(ledger, clock):
+    _, first = ledger.claim("event:1", lease_seconds=3)
+
+    clock.now += 2
+    assert not ledger.claim("event:1")[0]
+
+    clock.now += 2
+    acquired, second = ledger.claim("event:1")
+    assert acquired
+    assert second["token"] != first["token"]
+
+
+def test_stale_owner_cannot_overwrite_new_owner(ledger, clock):
+    _, first = ledger.claim("event:1", lease_seconds=3)
+    clock.now += 5
+    _, second = ledger.claim("event:1")
+
+    # 先に落ちたとみなされた処理の書き込みはトークンが一致せず失敗する
+    assert ledger.complete("event:1", first) is None
+    assert ledger.save("event:1", first, answer="stale") is first
+    assert ledger.get("event:1")["token"] == second["token"]
+    assert ledger.get("event:1")["status"] == STATUS_IN_PROGRESS
+
+
+def test_release_allows_immediate_reclaim(ledger, clock):
+    ledger.claim("slot:user:U1:0")
+    ledger.release("slot:user:U1:0")
+    assert ledger.claim("slot:user:U1:0")[0]
+
+
+def test_records_expire_after_ttl(ledger, clock):
+    _, record = ledger.claim("event:1")
+    ledger.fail("event:1", record)
+
+    clock.now += 3601
+    assert ledger.get("event:1") is None
+    acquired, record = ledger.claim("event:1")
+    assert acquired
+    assert record["data"] == {}
+
+
+def test_local_backends_are_not_shared(ledger):
+    assert not ledger.shared
+
+
+def test_failed_status_is_recorded(ledger, clock):
+    _, record = ledger.claim("generation:1")
+    ledger.fail("generation:1", record)
+    assert ledger.get("generation:1")["status"] == STATUS_FAILED
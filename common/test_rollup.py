@@ -0,0 +1,187 @@
+from rollup import (
+    HOUR_SECONDS,
+    HourlyRollupBuilder,
+    MemoryRollupStore,
+    closed_hours,
+    hour_of,
+    query_rollups,
+    save_scanned_rollups,
+)
+
+# ちょうど1時間の境界
+HOUR = 1_699_999_200
+
+
+def message(ts, user="U1", reactions=()):
+    return {
+        "ts": f"{ts:.6f}",
+        "user": user,
+        "reactions": [
+            {"name": name, "users": list(users)} for name, users in reactions
+        ],
+    }
+
+
+class FakeScan:
+    def __init__(self, messages, truncated=False):
+        self.messages = messages
+        self.truncated = truncated
+        self.calls = []
+
+    def __call__(self, oldest_ts, latest_ts):
+        self.calls.append((oldest_ts, latest_ts))
+        matched = [m for m in self.messages if oldest_ts <= float(m["ts"]) <= latest_ts]
+        return iter(matched), lambda: self.truncated
+
+
+def test_hour_of_is_start_of_hour():
+    assert hour_of(HOUR) == HOUR
+    assert hour_of(HOUR + HOUR_SECONDS - 0.000001) == HOUR
+    assert hour_of(f"{HOUR + HOUR_SECONDS:.6f}") == HOUR + HOUR_SECONDS
+
+
+def test_closed_hours_includes_hour_starting_at_oldest():
+    hours = closed_hours(HOUR, HOUR + 2 * HOUR_SECONDS, now=HOUR + 10 * HOUR_SECONDS)
+    assert hours == [HOUR, HOUR + HOUR_SECONDS]
+
+
+def test_closed_hours_excludes_partial_hours():
+    hours = closed_hours(
+        HOUR + 1, HOUR + 3 * HOUR_SECONDS - 1, now=HOUR + 10 * HOUR_SECONDS
+    )
+    assert hours == [HOUR + HOUR_SECONDS]
+
+
+def test_closed_hours_excludes_hours_not_yet_over():
+    hours = closed_hours(HOUR, HOUR + 3 * HOUR_SECONDS, now=HOUR + HOUR_SECONDS + 5)
+    assert hours == [HOUR]
+
+
+def test_builder_counts_messages_and_reactions_per_hour():
+    builder = HourlyRollupBuilder()
+    builder.add(message(HOUR, "U1", [("+1", ["U2", "U3"])]))
+    builder.add(message(HOUR + HOUR_SECONDS, "U2"))
+
+    rollups = builder.rollups([HOUR, HOUR + HOUR_SECONDS, HOUR + 2 * HOUR_SECONDS])
+    assert rollups[HOUR]["message_count"] == 1
+    assert rollups[HOUR]["reactions_received"] == {"U1": 2}
+    assert rollups[HOUR]["reactions_given"] == {"U2": 1, "U3": 1}
+    assert rollups[HOUR + HOUR_SECONDS]["messages_by_user"] == {"U2": 1}
+    assert rollups[HOUR + 2 * HOUR_SECONDS]["message_count"] == 0
+
+
+def test_query_counts_boundary_message_in_one_hour():
+    now = HOUR + 2 * HOUR_SECONDS + 30
+    # 1時間の境界ちょうどのメッセージは、隣り合う時間の走査の両方に含まれる
+    scan = FakeScan([message(HOUR + HOUR_SECONDS), message(HOUR + 10)])
+
+    summary = query_rollups(MemoryRollupStore(), "C1", HOUR, now, scan, now=now)
+    assert summary["message_count"] == 2
+
+
+def test_query_reuses_saved_hours_and_rescans_open_hour():
+    store = MemoryRollupStore()
+    now = HOUR + 2 * HOUR_SECONDS + 30
+    scan = FakeScan(
+        [message(HOUR + 5), message(HOUR + HOUR_SECONDS + 5), message(now - 10)]
+    )
+
+    first = query_rollups(store, "C1", HOUR, now, scan, now=now, settle_seconds=0)
+    assert first["message_count"] == 3
+    assert first["cache"]["computed_hours"] == 2
+    assert first["cache"]["live_hours"] == 1
+
+    scan.calls.clear()
+    second = query_rollups(store, "C1", HOUR, now, scan, now=now, settle_seconds=0)
+    assert second["message_count"] == 3
+    assert second["cache"]["cached_hours"] == 2
+    assert second["cache"]["computed_hours"] == 0
+    # 保存済みの時間は取得せず、現在の時間だけを取得し直す
+    assert scan.calls == [(HOUR + 2 * HOUR_SECONDS, now)]
+
+
+def test_query_does_not_save_truncated_hours():
+    store = MemoryRollupStore()
+    now = HOUR + 2 * HOUR_SECONDS + 30
+    scan = FakeScan([message(HOUR + 5)], truncated=True)
+
+    summary = query_rollups(store, "C1", HOUR, now, scan, now=now)
+    assert summary["truncated"]
+    assert store.get_hours("C1", [HOUR, HOUR + HOUR_SECONDS]) == {}
+
+
+def test_closed_hours_excludes_hours_still_settling():
+    hours = closed_hours(
+        HOUR,
+        HOUR + 3 * HOUR_SECONDS,
+        now=HOUR + 3 * HOUR_SECONDS,
+        settle_seconds=HOUR_SECONDS,
+    )
+    assert hours == [HOUR, HOUR + HOUR_SECONDS]
+
+
+def test_hours_are_not_saved_until_settled():
+    store = MemoryRollupStore()
+    now = HOUR + 2 * HOUR_SECONDS + 30
+    scan = FakeScan([message(HOUR + 5, reactions=[("+1", ["U2"])])])
+
+    summary = query_rollups(
+        store, "C1", HOUR, now, scan, now=now, settle_seconds=2 * HOUR_SECONDS
+    )
+    assert summary["reaction_count"] == 1
+    assert store.get_hours("C1", [HOUR, HOUR + HOUR_SECONDS]) == {}
+
+    # 後から付いたリアクションも、落ち着くまでは毎回集計し直して反映する
+    scan.messages = [message(HOUR + 5, reactions=[("+1", ["U2", "U3"])])]
+    summary = query_rollups(
+        store, "C1", HOUR, now, scan, now=now, settle_seconds=2 * HOUR_SECONDS
+    )
+    assert summary["reaction_count"] == 2
+    assert summary["cache"]["cached_hours"] == 0
+
+
+def test_rollup_saved_before_settling_is_recomputed():
+    store = MemoryRollupStore()
+    builder = HourlyRollupBuilder()
+    builder.add(message(HOUR + 5, reactions=[("+1", ["U2"])]))
+    # 1時間が終わった直後の走査で保存された集計（旧バージョンなど）
+    save_scanned_rollups(
+        store, "C1", builder, HOUR, HOUR + HOUR_SECONDS, settle_seconds=0
+    )
+    store._rollups[("C1", HOUR)]["computed_at"] = HOUR + HOUR_SECONDS + 60
+
+    now = HOUR + 30 * HOUR_SECONDS
+    scan = FakeScan([message(HOUR + 5, reactions=[("+1", ["U2", "U3", "U4"])])])
+    summary = query_rollups(
+        store,
+        "C1",
+        HOUR,
+        HOUR + HOUR_SECONDS - 1,
+        scan,
+        now=now,
+        settle_seconds=24 * HOUR_SECONDS,
+    )
+    assert summary["reaction_count"] == 3
+    assert summary["cache"]["computed_hours"] == 1
+    assert store.get_hours("C1", [HOUR])[HOUR]["reaction_count"] == 3
+
+
+def test_save_scanned_rollups_skips_unsettled_hours():
+    store = MemoryRollupStore()
+    now = HOUR + 3 * HOUR_SECONDS
+    saved = save_scanned_rollups(
+        store,
+        "C1",
+        HourlyRollupBuilder(),
+        HOUR,
+        now,
+        now=now,
+        settle_seconds=HOUR_SECONDS,
+    )
+    assert saved == 2
+    assert sorted(
+        store.get_hours("C1", [HOUR, HOUR + HOUR_SECONDS, HOUR + 2 * HOUR_SECONDS])
+    ) == [
+        HOUR,
+        HOUR + HOUR_SECONDS,
+    ]
@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+import slack_history
+from deadline import Deadline
+from slack_history import HistoryScanner, split_window
+
+NOW = 1_700_000_000.0
+
+
+class FakeWebClient:
+    """
+    conversations.history の代わり。oldest / latest の両端を含み、新しい順にページを返す
+    """
+
+    messages = []
+    calls = 0
+
+    def __init__(self, **kwargs):
+        self.timeout = kwargs.get("timeout")
+
+    def conversations_history(
+        self, channel, oldest, latest, inclusive, limit, cursor=None
+    ):
+        type(self).calls += 1
+        assert inclusive
+        matched = sorted(
+            (
+                m
+                for m in self.messages
+                if float(oldest) <= float(m["ts"]) <= float(latest)
+            ),
+            key=lambda m: -float(m["ts"]),
+        )
+        offset = int(cursor or 0)
+        page = matched[offset : offset + limit]
+        has_more = offset + limit < len(matched)
+        return {
+            "messages": page,
+            "has_more": has_more,
+            "response_metadata": {
+                "next_cursor": str(offset + limit) if has_more else ""
+            },
+        }
+
+
+@pytest.fixture
+def fake_slack(monkeypatch):
+    monkeypatch.setattr(slack_history, "WebClient", FakeWebClient)
+    FakeWebClient.calls = 0
+    FakeWebClient.messages = [
+        {"ts": f"{NOW - i * 10:.6f}", "user": f"U{i % 7}"} for i in range(3000)
+    ]
+    return FakeWebClient
+
+
+def test_split_window_covers_range_newest_first():
+    windows = split_window(100.0, 400.0, 3)
+    assert windows == [(300.0, 400.0), (200.0, 300.0), (100.0, 200.0)]
+
+
+def test_split_window_treats_invalid_shards_as_one():
+    assert split_window(100.0, 400.0, 0) == [(100.0, 400.0)]
+
+
+@pytest.mark.parametrize("shards", [1, 4, "auto"])
+def test_scan_returns_each_message_once(fake_slack, shards):
+    oldest = NOW - 30000
+    expected = {m["ts"] for m in fake_slack.messages if float(m["ts"]) >= oldest}
+
+    scanner = HistoryScanner("xoxb", "C1", max_shards=4)
+    scanned = [m["ts"] for m in scanner.scan(oldest, NOW, shards=shards)]
+
+    assert len(scanned) == len(set(scanned))
+    assert set(scanned) == expected
+    assert not scanner.truncated
+
+
+def test_messages_on_shard_boundaries_are_deduplicated(fake_slack):
+    oldest, latest = NOW - 4000, NOW
+    # 分割の境界ちょうどのメッセージは両側のシャードから返される
+    boundaries = {f"{start:.6f}" for start, _ in split_window(oldest, latest, 4)}
+    fake_slack.messages = [{"ts": ts, "user": "U1"} for ts in sorted(boundaries)] + [
+        {"ts": f"{NOW - i * 7:.6f}", "user": "U2"} for i in range(500)
+    ]
+
+    scanner = HistoryScanner("xoxb", "C1")
+    scanned = [m["ts"] for m in scanner.scan(oldest, latest, shards=4)]
+
+    assert len(scanned) == len(set(scanned))
+    assert boundaries <= set(scanned)
+    assert scanner.shard_count == 4
+
+
+def test_auto_shards_from_first_page_density(fake_slack):
+    scanner = HistoryScanner("xoxb", "C1", max_shards=8)
+    list(scanner.scan(NOW - 30000, NOW, shards="auto"))
+    # 最初のページ（200件 / 1990秒）から期間全体を約3015件と見積もり、1000件ごとに分割する
+    assert scanner.shard_count == 4
+
+
+def test_expired_deadline_truncates_scan(fake_slack):
+    scanner = HistoryScanner("xoxb", "C1", deadline=Deadline(0, margin_ms=0))
+    assert list(scanner.scan(NOW - 30000, NOW)) == []
+    assert scanner.truncated
+
+
+def test_reserve_stops_scan_before_deadline(fake_slack):
+    deadline = Deadline(60_000, margin_ms=0)
+    scanner = HistoryScanner("xoxb", "C1", deadline=deadline, reserve=120)
+    assert list(scanner.scan(NOW - 30000, NOW)) == []
+    assert scanner.truncated
+
+
+def test_abandoned_sharded_scan_stops_workers(fake_slack):
+    scanner = HistoryScanner("xoxb", "C1")
+    messages = scanner.scan(NOW - 30000, NOW, shards=4)
+    next(messages)
+    messages.close()
+
+    assert threading.active_count() == 1
+    # キューの大きさを制限しているため、読み進めていないページを取得し続けない
+    assert fake_slack.calls <= 1 + 2 * 4 + 4
+
+
+@pytest.mark.parametrize("shards", [1, 4])
+def test_page_timeout_keeps_scanned_messages(fake_slack, monkeypatch, shards):
+    conversations_history = FakeWebClient.conversations_history
+
+    def slow_third_page(self, *args, **kwargs):
+        if type(self).calls >= 2:
+            type(self).calls += 1
+            raise TimeoutError("read timed out")
+        return conversations_history(self, *args, **kwargs)
+
+    monkeypatch.setattr(FakeWebClient, "conversations_history", slow_third_page)
+    scanner = HistoryScanner("xoxb", "C1")
+    scanned = list(scanner.scan(NOW - 30000, NOW, shards=shards))
+
+    assert len(scanned) == 400
+    assert scanner.truncated
+
+
+def test_page_timeout_leaves_reserve(fake_slack):
+    deadline = Deadline(30_000, margin_ms=0)
+    scanner = HistoryScanner("xoxb", "C1", deadline=deadline, reserve=20)
+    client = scanner._client()
+    # 後処理の20秒を残すため、SLACK_TIMEOUT_SECONDS ではなく残りの約10秒になる
+    assert client.timeout <= 10
+    next(scanner._pages(client, NOW - 30000, NOW))
+    assert client.timeout <= 10
@@ -0,0 +1,104 @@
+##################################################
+# コールドスタート対策のウォームアップと、接続プールの状態のメトリクス出力
+#
+# 利用する関数: dify_authorizer / dify_slack_bot_mention
+##################################################
+
+import os
+import json
+import time
+
+# CloudWatchメトリクスの名前空間（Embedded Metric Format でログに出力する）
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "PrAIs")
+
+# このコンテナで最初の呼び出しかどうか
+_state = {"cold": True, "warmed_at": None}
+
+
+def is_warmup_event(event):
+    """
+    ウォームアップ用のイベントかどうか
+    {"warmup": true} またはEventBridgeのスケジュール（source: aws.events）からの呼び出し
+    """
+    if not isinstance(event, dict):
+        return False
+    return bool(event.get("warmup")) or event.get("source") == "aws.events"
+
+
+def mark_warmed():
+    # ウォームアップで初期化済みのため、以降のリクエストはコールドスタートではない
+    _state["cold"] = False
+    _state["warmed_at"] = time.time()
+
+
+def idle_connections(pool_manager, url):
+    """
+    urllib3のPoolManagerに、url への接続済み（keep-alive中）のコネクションがいくつあるか
+    内部の状態を参照するため、取得できない場合は None を返します。
+    """
+    try:
+        pool = pool_manager.connection_from_url(url)
+        return sum(
+            1
+            for conn in list(pool.pool.queue)
+            if conn is not None and getattr(conn, "sock", None) is not None
+        )
+    except Exception:
+        return None
+
+
+def boto_idle_connections(client):
+    """
+    boto3クライアントのエンドポイントへの接続済みのコネクション数
+    """
+    try:
+        manager = client._endpoint.http_session._manager
+        return idle_connections(manager, client.meta.endpoint_url)
+    except Exception:
+        return None
+
+
+def emit_pool_metrics(context, pools, counts=None):
+    """
+    実際のリクエストがコールドスタートだったか、接続プールが温まっていたかを
+    CloudWatch Embedded Metric Format でログに出力します。
+    pools は {名前: 接続済みのコネクション数} の辞書です。
+    counts には、そのほかに出力する {メトリクス名: 値} を指定できます。
+    """
+    function_name = getattr(context, "function_name", None) or os.environ.get(
+        "AWS_LAMBDA_FUNCTION_NAME", "local"
+    )
+    cold = _state["cold"]
+    _state["cold"] = False
+
+    metrics = {"ColdStart": int(cold)}
+    for name, idle in pools.items():
+        if idle is not None:
+            metrics[f"{name}WarmPool"] = int(idle > 0)
+    metrics.update(counts or {})
+
+    warmed_at = _state["warmed_at"]
+    print(
+        json.dumps(
+            {
+                "_aws": {
+                    "Timestamp": int(time.time() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": METRICS_NAMESPACE,
+                            "Dimensions": [["FunctionName"]],
+                            "Metrics": [
+                                {"Name": name, "Unit": "Count"} for name in metrics
+                            ],
+                        }
+                    ],
+                },
+                "FunctionName": function_name,
+                "SecondsSinceWarmup": (
+                    round(time.time() - warmed_at, 1) if warmed_at else None
+                ),
+                **metrics,
+            }
+        )
+    )
+    return metrics
@@ -1,27 +1,91 @@
 import json
-import boto3
 import os
+import time
+
+from deadline import Deadline
+from warmup import (
+    boto_idle_connections,
+    emit_pool_metrics,
+    is_warmup_event,
+    mark_warmed,
+)
 
 # Secrets Managerからシークレット名を取得
 SECRET_NAME = os.environ["SECRET_NAME"]
-secrets_client = boto3.client("secretsmanager")
 
+# Secrets Manager呼び出しのタイムアウト上限（秒）
+SECRETS_TIMEOUT_SECONDS = 5
+# 取得したAPIキーをキャッシュする時間（秒）。ローテーションに追従できる程度に短くする
+SECRET_CACHE_SECONDS = int(os.environ.get("SECRET_CACHE_SECONDS", 300))
+
+_secret_cache = {"value": None, "fetched_at": 0.0}
+
+
+def secret_cached():
+    """キャッシュしたAPIキーが有効期間内かどうか"""
+    return bool(
+        _secret_cache["value"]
+        and time.time() - _secret_cache["fetched_at"] < SECRET_CACHE_SECONDS
+    )
 
-def get_secret_key():
-    """Secrets ManagerからAPIキーを取得"""
+
+def get_secret_key(deadline=None):
+    """Secrets ManagerからAPIキーを取得（一定時間はキャッシュを使う）"""
+    deadline = deadline or Deadline()
+    if secret_cached():
+        return _secret_cache["value"]
     try:
+        secrets_client = deadline.boto_client(
+            "secretsmanager", cap=SECRETS_TIMEOUT_SECONDS
+        )
         response = secrets_client.get_secret_value(SecretId=SECRET_NAME)
         secret = json.loads(response["SecretString"])
+        _secret_cache["value"] = secret["api_key"]
+        _secret_cache["fetched_at"] = time.time()
         return secret["api_key"]
     except Exception as e:
         print(f"Error retrieving secret: {e}")
         raise e
 
 
+def record_metrics(context, deadline):
+    """
+    実際のリクエストについて、APIキーをキャッシュから取得できるか（SecretCacheHit）と、
+    キャッシュが切れていてSecrets Managerを呼び出す場合は接続プールが温まっていたかを記録します。
+    メトリクスの出力に失敗しても認可の判定には影響させません。
+    """
+    try:
+        cached = secret_cached()
+        pools = {}
+        if not cached:
+            pools["SecretsManager"] = boto_idle_connections(
+                deadline.boto_client("secretsmanager", cap=SECRETS_TIMEOUT_SECONDS)
+            )
+        emit_pool_metrics(context, pools, {"SecretCacheHit": int(cached)})
+    except Exception as e:
+        print(f"Failed to emit metrics: {e}")
+
+
 def lambda_handler(event, context):
+    # Lambdaの残り実行時間から、外部呼び出しに使える期限を決める
+    deadline = Deadline.from_context(context)
+
+    # ウォームアップの呼び出しでは、Secrets Managerへの接続とAPIキーの取得だけを行ってすぐに返す
+    if is_warmup_event(event):
+        try:
+            get_secret_key(deadline)
+        except Exception:
+            pass
+        mark_warmed()
+        print("Warm-up completed.")
+        return {"isAuthorized": False}
+
+    # 実際のリクエストがキャッシュや温まった接続プールを使えたかどうかを記録する
+    record_metrics(context, deadline)
+
     try:
         # 正しいAPIキーを取得
-        valid_api_key = get_secret_key()
+        valid_api_key = get_secret_key(deadline)
 
         # Difyから送られてきたヘッダーの値を取得
         # ヘッダー名はAPI Gatewayによって小文字に変換されます
@@ -1,44 +1,129 @@
 import json
 import os
+import hashlib
 import boto3
 import urllib3
 
+from capture import capture
+from deadline import Deadline
+from idempotency import create_ledger
+from warmup import (
+    boto_idle_connections,
+    emit_pool_metrics,
+    idle_connections,
+    is_warmup_event,
+    mark_warmed,
+)
+
 # ★★★ 実行係のLambda関数の名前に書き換えてください ★★★
 PROCESSOR_FUNCTION_NAME = "dify-slack-bot-processor"
 SLACK_BOT_TOKEN = os.environ["SLACK_BOT_TOKEN"]
 
-sqs_client = boto3.client("sqs")
 QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
+# 短い質問・初めての質問を優先して送るキュー（未設定の場合は QUEUE_URL に送る）
+PRIORITY_QUEUE_URL = os.environ.get("SQS_PRIORITY_QUEUE_URL")
+
+# 公平に処理するための単位: user（ユーザーごと） / channel（チャンネルごと）
+# FIFOキューの場合はこの単位をメッセージグループとし、1人の大量の質問が他の人を待たせないようにする
+FAIR_KEY = os.environ.get("FAIR_KEY", "user")
+# この文字数以下の質問は短い質問として優先する
+SHORT_QUESTION_CHARS = int(os.environ.get("SHORT_QUESTION_CHARS", 80))
 
 lambda_client = boto3.client("lambda")
 http = urllib3.PoolManager()
 
+# 外部呼び出しのタイムアウト上限（秒）
+# Slackは数秒以内に応答がないと再送するため、短めにしている
+SLACK_TIMEOUT_SECONDS = 3
+SQS_TIMEOUT_SECONDS = 3
+
+SLACK_API_URL = "https://slack.com/api"
+
+# Slackの再送やSQSの重複配信で同じ質問を二重に処理しないための台帳
+# 失敗した質問をSlackの再送でやり直すには、コンテナ間で共有できる保存先（IDEMPOTENCY_BACKEND=dynamodb）が必要
+ledger = create_ledger()
+if not ledger.shared:
+    print(
+        "Idempotency ledger is not shared. "
+        "Slack retries are skipped, so failed events are not retried."
+    )
+
 
 def lambda_handler(event, context):
+    # Lambdaの残り実行時間から、外部呼び出しに使える期限を決める
+    deadline = Deadline.from_context(context)
+
+    # ウォームアップの呼び出しでは、クライアントの初期化と接続だけを行ってすぐに返す
+    if is_warmup_event(event):
+        warm_up(deadline)
+        return {"statusCode": 200, "body": "warmed"}
+
+    # 負荷試験用にリクエストを匿名化して記録する（環境変数 CAPTURE を設定した場合のみ）
+    capture("apigw", event)
+
+    # 実際のリクエストが温まった接続プールを使えたかどうかを記録する
+    # （メトリクスの出力に失敗しても質問の受け付けには影響させない）
+    try:
+        emit_pool_metrics(
+            context,
+            {
+                "Slack": idle_connections(http, SLACK_API_URL),
+                "SQS": boto_idle_connections(
+                    deadline.boto_client("sqs", cap=SQS_TIMEOUT_SECONDS)
+                ),
+            },
+        )
+    except Exception as e:
+        print(f"Failed to emit metrics: {e}")
+
     body = json.loads(event.get("body", "{}"))
     if "challenge" in body:
         return {"statusCode": 200, "body": json.dumps({"challenge": body["challenge"]})}
 
-    try:
-        slack_event = body.get("event", {})
+    slack_event = body.get("event", {})
+
+    # ボット自身のメッセージには応答しない
+    if slack_event.get("subtype") == "bot_message":
+        return {"statusCode": 200, "body": "ok"}
 
-        # 봇 자신의 메시지나 재전송 이벤트에 응답하지 않도록 방지
-        if slack_event.get(
-            "subtype"
-        ) == "bot_message" or "X-Slack-Retry-Num" in event.get("headers", {}):
+    # 再送イベントは台帳で処理済みかどうかを判定する（初回の処理が失敗していた場合は、再送で処理をやり直す）
+    # 台帳をコンテナ間で共有していない場合は、別のコンテナに届いた再送を判定できないため一律に捨てる
+    retry_num = (event.get("headers") or {}).get("X-Slack-Retry-Num")
+    if retry_num:
+        print(f"Slack retry received: X-Slack-Retry-Num={retry_num}")
+        if not ledger.shared:
+            print("Idempotency ledger is not shared. Retry skipped.")
             return {"statusCode": 200, "body": "ok"}
 
+    idempotency_key = body.get("event_id") or slack_event.get("client_msg_id")
+    ledger_key = f"event:{idempotency_key}"
+    record = None
+    if idempotency_key:
+        # リースはこの呼び出しが終わるまでとし、タイムアウトなどで落ちた場合は次の再送で引き継げるようにする
+        acquired, record = ledger.claim(
+            ledger_key, lease_seconds=deadline.lease_seconds()
+        )
+        if not acquired:
+            print(f"Event {idempotency_key} is already {record['status']}. Skipped.")
+            return {"statusCode": 200, "body": "ok"}
+
+    try:
         question = slack_event.get("text", "").split(">", 1)[-1].strip()
         channel_id = slack_event.get("channel")
         user_id = slack_event.get("user")
 
-        # 「考え中」メッセージを投稿し、その応答（メッセージ情報）を取得
-        initial_message_response = post_slack_message(
-            channel_id, f"<@{user_id}> 考え中... 🤔"
-        )
+        # 前回の試行で「考え中」メッセージを投稿済みであれば、それを再利用する
+        message_ts = (record or {}).get("data", {}).get("message_ts")
+        if not message_ts:
+            # 「考え中」メッセージを投稿し、その応答（メッセージ情報）を取得
+            initial_message_response = post_slack_message(
+                channel_id, f"<@{user_id}> 考え中... 🤔", deadline
+            )
 
-        # 投稿したメッセージのタイムスタンプ（メッセージID）を取得
-        message_ts = initial_message_response.get("ts")
+            # 投稿したメッセージのタイムスタンプ（メッセージID）を取得
+            message_ts = initial_message_response.get("ts")
+            if record and message_ts:
+                record = ledger.save(ledger_key, record, message_ts=message_ts)
 
         # タイムスタンプが正常に取得できた場合のみ、実行係を呼び出す
         if message_ts:
@@ -62,6 +147,11 @@ def lambda_handler(event, context):
                 "channel_id": channel_id,
                 "user_id": user_id,
                 "message_ts": message_ts,
+                # 実行係で同じ質問に対してDifyを二重に呼ばないためのキー
+                "idempotency_key": slack_event.get("client_msg_id") or idempotency_key,
+                # 実行係で同時実行数を制限する単位と、処理の優先度
+                "fair_key": fair_key_of(user_id, channel_id),
+                "priority": is_priority(question, user_id),
             }
 
             # メッセージを文字列に変換
@@ -75,30 +165,104 @@ def lambda_handler(event, context):
                 }
 
             # SQSにメッセージを送信
-            try:
-                response = sqs_client.send_message(
-                    QueueUrl=QUEUE_URL,
-                    MessageBody=message_body_str,
-                    # MessageAttributes={
-                    #     'attribute1': {
-                    #         'StringValue': 'value1',
-                    #         'DataType': 'String'
-                    #     }
-                    # }
-                )
-
-            except Exception as e:
-                print(f"Error in responder function: {e}")
+            # 失敗した場合は例外をそのまま投げ、台帳に失敗を記録してSlackの再送に任せる
+            sqs_client = deadline.boto_client("sqs", cap=SQS_TIMEOUT_SECONDS)
+            response = sqs_client.send_message(
+                **queue_params(message_body),
+                MessageBody=message_body_str,
+                # MessageAttributes={
+                #     'attribute1': {
+                #         'StringValue': 'value1',
+                #         'DataType': 'String'
+                #     }
+                # }
+            )
+
+        if record:
+            ledger.complete(ledger_key, record)
 
     except Exception as e:
         print(f"Unhandled error: {e}")
+        if record:
+            ledger.fail(ledger_key, record)
+            # 再送を処理できる場合だけ、失敗を返してSlackに再送してもらう
+            # （台帳を共有していない場合は再送を捨てるため、失敗を返してもやり直されない）
+            if ledger.shared:
+                return {"statusCode": 500, "body": "error"}
 
     # SlackにはすぐにOKを返す
     return {"statusCode": 200, "body": "ok"}
 
 
-def post_slack_message(channel_id, text):
+def warm_up(deadline):
+    """
+    Slack・SQS・台帳への接続を事前に確立し、keep-aliveの接続をプールに残しておく
+    （応答の内容は使わないため、権限エラーなどは無視する）
+    """
+    try:
+        http.request(
+            "GET",
+            f"{SLACK_API_URL}/api.test",
+            timeout=deadline.timeout(SLACK_TIMEOUT_SECONDS),
+        )
+    except Exception as e:
+        print(f"Warm-up request to Slack failed: {e}")
+
+    try:
+        sqs_client = deadline.boto_client("sqs", cap=SQS_TIMEOUT_SECONDS)
+        if QUEUE_URL:
+            sqs_client.get_queue_attributes(
+                QueueUrl=QUEUE_URL, AttributeNames=["QueueArn"]
+            )
+    except Exception as e:
+        print(f"Warm-up request to SQS failed: {e}")
+
+    try:
+        ledger.get("warmup")
+    except Exception as e:
+        print(f"Warm-up request to ledger failed: {e}")
+
+    mark_warmed()
+    print("Warm-up completed.")
+
+
+def fair_key_of(user_id, channel_id):
+    """公平に処理するための単位（ユーザーまたはチャンネル）"""
+    if FAIR_KEY == "channel":
+        return f"channel:{channel_id}"
+    return f"user:{user_id}"
+
+
+def is_priority(question, user_id):
+    """
+    短い質問、または（台帳の保持期間内で）初めて質問したユーザーの質問を優先する
+    """
+    first_time, record = ledger.claim(f"user-seen:{user_id}")
+    if first_time:
+        ledger.complete(f"user-seen:{user_id}", record)
+    return first_time or len(question) <= SHORT_QUESTION_CHARS
+
+
+def queue_params(message_body):
+    """
+    送信先のキューと、FIFOキューの場合のメッセージグループ・重複排除IDを決める
+    """
+    queue_url = QUEUE_URL
+    if message_body["priority"] and PRIORITY_QUEUE_URL:
+        queue_url = PRIORITY_QUEUE_URL
+    params = {"QueueUrl": queue_url}
+    if queue_url.endswith(".fifo"):
+        params["MessageGroupId"] = message_body["fair_key"]
+        dedup_key = message_body["idempotency_key"] or message_body["message_ts"]
+        params["MessageDeduplicationId"] = hashlib.sha256(
+            dedup_key.encode("utf-8")
+        ).hexdigest()
+    return params
+
+
+def post_slack_message(channel_id, text, deadline=None):
     """Slackにメッセージを投稿し、APIからの応答を返す"""
+    deadline = deadline or Deadline()
     headers = {
         "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
         "Content-Type": "application/json",
@@ -107,9 +271,10 @@ def post_slack_message(channel_id, text):
 
     response = http.request(
         "POST",
-        "https://slack.com/api/chat.postMessage",
+        f"{SLACK_API_URL}/chat.postMessage",
         headers=headers,
         body=json.dumps(payload).encode("utf-8"),
+        timeout=deadline.timeout(SLACK_TIMEOUT_SECONDS),
     )
     # 応答をJSONとして解釈して返す
     return json.loads(response.data.decode("utf-8"))
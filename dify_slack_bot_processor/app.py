@@ -1,15 +1,52 @@
 import json
 import os
 import urllib3
+from concurrent.futures import ThreadPoolExecutor
+
+from capture import capture
+from deadline import Deadline
+from idempotency import STATUS_IN_PROGRESS, create_ledger
 
 SLACK_BOT_TOKEN = os.environ["SLACK_BOT_TOKEN"]
 DIFY_API_KEY = os.environ["DIFY_API_KEY"]
 DIFY_API_URL = os.environ["DIFY_API_URL"]
 
-http = urllib3.PoolManager()
+# 外部呼び出しのタイムアウト上限（秒）。実際にはLambdaの残り時間も考慮して決める
+DIFY_TIMEOUT_SECONDS = 300
+SLACK_TIMEOUT_SECONDS = 10
+SQS_TIMEOUT_SECONDS = 5
+
+# 同じユーザー（またはチャンネル）について同時に実行するDify呼び出しの上限
+MAX_IN_FLIGHT_PER_KEY = int(os.environ.get("MAX_IN_FLIGHT_PER_KEY", 1))
+# 1回の呼び出しで受け取ったメッセージを並列に処理する数
+PROCESSOR_CONCURRENCY = int(os.environ.get("PROCESSOR_CONCURRENCY", 10))
+# 枠が空いていないメッセージを再配信するまでの秒数（キューの可視性タイムアウトの代わりに使う）
+SLOT_RETRY_DELAY_SECONDS = int(os.environ.get("SLOT_RETRY_DELAY_SECONDS", 10))
+
+http = urllib3.PoolManager(maxsize=PROCESSOR_CONCURRENCY)
+
+# SQSの重複配信で同じ質問に対してDifyを二重に呼ばないための台帳
+# ユーザーごとの同時実行数の枠もこの台帳で管理するため、呼び出しをまたいで上限を守るには
+# コンテナ間で共有できる保存先（IDEMPOTENCY_BACKEND=dynamodb）が必要
+ledger = create_ledger()
+if not ledger.shared:
+    print(
+        "Idempotency ledger is not shared. "
+        "MAX_IN_FLIGHT_PER_KEY applies only within each container."
+    )
 
 
 def lambda_handler(event, context):
+    """
+    SQSから受け取ったメッセージ（複数件の場合もある）を処理します。
+
+    優先度の高いもの（短い質問・初めての質問）から順に、ユーザーごとの同時実行数の枠を取得し、
+    枠を取得できたものだけを並列に処理します。
+    枠が空いていないメッセージは batchItemFailures として返し、SLOT_RETRY_DELAY_SECONDS 秒後に
+    SQSで再配信させます。（イベントソースマッピングで ReportBatchItemFailures を有効にしてください）
+    """
+    # Lambdaの残り実行時間から、外部呼び出しに使える期限を決める
+    deadline = Deadline.from_context(context)
 
     # 受付係から渡された情報を受け取る
     # question = event['question']
@@ -19,41 +56,178 @@ def lambda_handler(event, context):
 
     # 受付係から渡された情報を受け取る（SQS経由）
     # messageは json string なので辞書に変換
+    messages = []
+    for sqs_record in event["Records"]:
+        # 負荷試験用にレコードを匿名化して記録する（環境変数 CAPTURE を設定した場合のみ）
+        capture("sqs", sqs_record)
+        try:
+            messages.append((sqs_record, json.loads(sqs_record["body"])))
+        except json.JSONDecodeError:
+            # 再配信しても解決しないため、ログに残して捨てる
+            print("Failed to decode JSON from the message body.")
+
+    # 優先度の高いもの、質問の短いものから順に処理する
+    messages.sort(
+        key=lambda item: (
+            not item[1].get("priority", False),
+            len(item[1].get("question", "")),
+        )
+    )
+
+    batch_item_failures = []
+    deferred = []
+    scheduled = []
+    for sqs_record, message_body in messages:
+        fair_key = message_body.get("fair_key") or f"user:{message_body['user_id']}"
+        slot = acquire_slot(fair_key, deadline)
+        if slot is None:
+            print(f"Too many in-flight generations for {fair_key}. Retry later.")
+            batch_item_failures.append({"itemIdentifier": sqs_record.get("messageId")})
+            deferred.append(sqs_record)
+            continue
+        scheduled.append((sqs_record, message_body, slot))
+
+    if scheduled:
+        with ThreadPoolExecutor(
+            max_workers=min(PROCESSOR_CONCURRENCY, len(scheduled))
+        ) as executor:
+            futures = [
+                (
+                    sqs_record,
+                    executor.submit(process_with_slot, message_body, slot, deadline),
+                )
+                for sqs_record, message_body, slot in scheduled
+            ]
+        # 別の呼び出しが処理中のメッセージは確認済みにせず、可視性タイムアウト後に再配信させる
+        # （その呼び出しが落ちていた場合は、再配信でリースの切れた処理を引き継ぐ）
+        for sqs_record, future in futures:
+            if not future.result():
+                batch_item_failures.append(
+                    {"itemIdentifier": sqs_record.get("messageId")}
+                )
+
+    # 枠が空くのを待つメッセージは、キューの可視性タイムアウト（関数のタイムアウト以上）ではなく
+    # 短い間隔で再配信させる。枠を持つ処理が終わってから変更するため、待ちは枠が空いてからの秒数になる
+    delay_redelivery(deferred, SLOT_RETRY_DELAY_SECONDS, deadline)
+
+    return {
+        "statusCode": 200,
+        "body": "Processing complete.",
+        "batchItemFailures": batch_item_failures,
+    }
+
+
+def acquire_slot(fair_key, deadline):
+    """
+    ユーザー（またはチャンネル）ごとの同時実行数の枠を取得します。
+    空いている枠がない場合は None を返します。
+    枠のリースはこの呼び出しが終わるまでとし、呼び出しが落ちても枠が残り続けないようにします。
+    """
+    for i in range(MAX_IN_FLIGHT_PER_KEY):
+        slot_key = f"slot:{fair_key}:{i}"
+        acquired, _ = ledger.claim(slot_key, lease_seconds=deadline.lease_seconds())
+        if acquired:
+            return slot_key
+    return None
+
+
+def queue_url_from_arn(arn):
+    """SQSのARN（arn:aws:sqs:リージョン:アカウントID:キュー名）からキューのURLを組み立てます。"""
+    _, _, _, region, account_id, queue_name = arn.split(":")
+    return f"https://sqs.{region}.amazonaws.com/{account_id}/{queue_name}"
+
+
+def delay_redelivery(sqs_records, delay_seconds, deadline):
+    """
+    batchItemFailures として返すメッセージの可視性タイムアウトを delay_seconds 秒に変更します。
+    変更できなかったメッセージは、キューの可視性タイムアウトの経過後に再配信されます。
+    """
+    for sqs_record in sqs_records:
+        if not sqs_record.get("receiptHandle") or not sqs_record.get("eventSourceARN"):
+            continue
+        try:
+            sqs_client = deadline.boto_client("sqs", cap=SQS_TIMEOUT_SECONDS)
+            sqs_client.change_message_visibility(
+                QueueUrl=queue_url_from_arn(sqs_record["eventSourceARN"]),
+                ReceiptHandle=sqs_record["receiptHandle"],
+                VisibilityTimeout=delay_seconds,
+            )
+        except Exception as e:
+            print(f"Failed to change message visibility: {e}")
+
+
+def process_with_slot(message_body, slot_key, deadline):
+    """
+    メッセージを処理して枠を解放します。
+    メッセージを確認済み（SQSから削除してよい）とする場合は True を返します。
+    """
     try:
-        message_body = json.loads(event["Records"][0]["body"])
-    except json.JSONDecodeError:
-        print("Failed to decode JSON from the message body.")
-        return {"statusCode": 400, "body": "Invalid message body."}
+        return process_message(message_body, deadline)
+    except Exception as e:
+        print(f"An exception occurred: {e}")
+        return True
+    finally:
+        ledger.release(slot_key)
+
+
+def process_message(message_body, deadline):
+    """
+    1件の質問についてDifyを呼び出し、「考え中」メッセージを回答に更新します。
+    別の呼び出しが処理中のため再配信を待つ場合は False を返します。
+    """
     question = message_body["question"]
     channel_id = message_body["channel_id"]
     user_id = message_body["user_id"]
     message_ts = message_body["message_ts"]  # ★メッセージのタイムスタンプを受け取る
 
+    # 同じ質問がすでに処理済み・処理中であれば何もしない
+    idempotency_key = (
+        message_body.get("idempotency_key") or f"{channel_id}:{message_ts}"
+    )
+    ledger_key = f"generation:{idempotency_key}"
+    # リースはこの呼び出しが終わるまでとし、落ちた場合は再配信で引き継げるようにする
+    acquired, record = ledger.claim(ledger_key, lease_seconds=deadline.lease_seconds())
+    if not acquired:
+        print(f"Question {idempotency_key} is already {record['status']}. Skipped.")
+        return record["status"] != STATUS_IN_PROGRESS
+
     try:
-        dify_response_text = call_dify_api(question, user_id)
+        # 前回の試行でDifyの回答を取得済みであれば、それを再利用する
+        if "answer" in record["data"]:
+            dify_response_text = record["data"]["answer"]
+        else:
+            dify_response_text = call_dify_api(question, user_id, deadline)
+            record = ledger.save(ledger_key, record, answer=dify_response_text)
 
         # Difyから有効な回答があった場合
         if dify_response_text:
             # ★既存のメッセージをDifyの回答に更新する
             update_slack_message(
-                channel_id, message_ts, f"<@{user_id}> {dify_response_text}"
+                channel_id, message_ts, f"<@{user_id}> {dify_response_text}", deadline
             )
         # Difyから回答がなかった場合
         else:
             # ★「考え中...」メッセージを削除して、何もなかったことにする
-            delete_slack_message(channel_id, message_ts)
+            delete_slack_message(channel_id, message_ts, deadline)
+
+        ledger.complete(ledger_key, record)
 
     except Exception as e:
         print(f"An exception occurred: {e}")
+        ledger.fail(ledger_key, record)
         # ★エラーが発生した場合は、メッセージを更新してユーザーに知らせる
         update_slack_message(
-            channel_id, message_ts, f"<@{user_id}> ごめんなさい、エラーが発生しました。"
+            channel_id,
+            message_ts,
+            f"<@{user_id}> ごめんなさい、エラーが発生しました。",
+            deadline,
         )
 
-    return {"statusCode": 200, "body": "Processing complete."}
+    return True
 
 
-def call_dify_api(query, user_id):
+def call_dify_api(query, user_id, deadline=None):
+    deadline = deadline or Deadline()
     headers = {
         "Authorization": f"Bearer {DIFY_API_KEY}",
         "Content-Type": "application/json",
@@ -63,8 +237,13 @@ def call_dify_api(query, user_id):
         "response_mode": "streaming",
         "user": f"slack-{user_id}",
     }
+    # 回答後にSlackのメッセージを更新する時間を残してタイムアウトを決める
     response = http.request(
-        "POST", DIFY_API_URL, headers=headers, body=json.dumps(payload).encode("utf-8")
+        "POST",
+        DIFY_API_URL,
+        headers=headers,
+        body=json.dumps(payload).encode("utf-8"),
+        timeout=deadline.timeout(DIFY_TIMEOUT_SECONDS, reserve=SLACK_TIMEOUT_SECONDS),
     )
 
     # Difyからの応答がエラーでないことを確認
@@ -86,8 +265,9 @@ def call_dify_api(query, user_id):
 
 
 # ★関数をsendからupdateとdeleteに変更
-def update_slack_message(channel_id, ts, text):
+def update_slack_message(channel_id, ts, text, deadline=None):
     """既存のSlackメッセージを更新する"""
+    deadline = deadline or Deadline()
     headers = {
         "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
         "Content-Type": "application/json",
@@ -98,11 +278,13 @@ def update_slack_message(channel_id, ts, text):
         "https://slack.com/api/chat.update",  # chat.update API を使用
         headers=headers,
         body=json.dumps(payload).encode("utf-8"),
+        timeout=deadline.timeout(SLACK_TIMEOUT_SECONDS),
     )
 
 
-def delete_slack_message(channel_id, ts):
+def delete_slack_message(channel_id, ts, deadline=None):
     """既存のSlackメッセージを削除する"""
+    deadline = deadline or Deadline()
     headers = {
         "Authorization": f"Bearer {SLACK_BOT_TOKEN}",
         "Content-Type": "application/json",
@@ -113,4 +295,5 @@ def delete_slack_message(channel_id, ts):
         "https://slack.com/api/chat.delete",  # chat.delete API を使用
         headers=headers,
         body=json.dumps(payload).encode("utf-8"),
+        timeout=deadline.timeout(SLACK_TIMEOUT_SECONDS),
     )
@@ -3,26 +3,226 @@
 ##################################################
 
 import os
+import re
 import json
-import time
 from datetime import datetime, timedelta, timezone
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
+from deadline import Deadline
+from export import create_exporter
+from rollup import (
+    HourlyRollupBuilder,
+    create_rollup_store,
+    query_recent_rollups,
+    save_scanned_rollups,
+)
+from slack_history import HistoryScanner
+
 # 遡ってメッセージを取得する期間（分数）
 MINUTES_TO_FETCH = 120
 
+# Slack API呼び出し1回あたりのタイムアウト上限（秒）
+SLACK_TIMEOUT_SECONDS = 30
+
+# 取得したメッセージの整形（ユーザー情報の取得）のために残しておく時間の割合と上限（秒）
+# 履歴の取得はこの時間を残して打ち切り、取得できた分は必ず結果に含める
+FORMAT_RESERVE_RATIO = 0.3
+FORMAT_RESERVE_MAX_SECONDS = 120
+
+# 1時間ごとの集計の保存先（初回の呼び出し時に作成する）
+_rollup_store = None
+
+
+def get_rollup_store():
+    global _rollup_store
+    if _rollup_store is None:
+        _rollup_store = create_rollup_store()
+    return _rollup_store
 
-def fetch_slack_messages(token, channel_id, minutes):
+
+def save_rollups(channel_id, builder, oldest_ts, latest_ts):
+    """
+    走査したメッセージの1時間ごとの集計を保存します。
+    集計の保存に失敗しても、本来の取得結果には影響させません。
+    """
+    try:
+        saved = save_scanned_rollups(
+            get_rollup_store(), channel_id, builder, oldest_ts, latest_ts
+        )
+        print(f"📊 {saved}時間分の集計を保存しました。")
+    except Exception as e:
+        print(f"Failed to save rollups: {e}")
+
+
+def _parse_bool(value):
+    """
+    "true" / "1" / "yes" などの文字列も真偽値として解釈します。
+    クエリパラメータ経由では文字列で渡されるため。
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "1", "yes", "on")
+
+
+def _parse_list(value):
+    """
+    リストまたはカンマ区切りの文字列をリストに変換します。
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [v.strip() for v in value if v and v.strip()]
+
+
+def _is_thread_reply(message):
+    """
+    スレッドへの返信かどうか（スレッドの親メッセージは含まない）
+    conversations.history が返す返信は「チャンネルにも投稿」されたものだけのため、
+    それ以外の返信はそもそも取得結果に含まれない。
+    """
+    thread_ts = message.get("thread_ts")
+    return bool(thread_ts) and thread_ts != message.get("ts")
+
+
+def build_message_filter(
+    user_ids=None,
+    keyword=None,
+    regex=None,
+    min_reactions=None,
+    has_files=None,
+    include_thread_replies=True,
+):
+    """
+    Slack APIから取得した生のメッセージに対する絞り込み条件を作成します。
+    ユーザー情報の取得や整形の前に適用するため、条件に合わないメッセージに
+    余計なAPI呼び出しをしなくて済みます。
+    条件が指定されていない場合は None を返します。
+    """
+    user_ids = set(_parse_list(user_ids))
+    keyword = keyword.lower() if keyword else None
+    pattern = re.compile(regex) if regex else None
+    min_reactions = int(min_reactions) if min_reactions not in (None, "") else None
+    has_files = _parse_bool(has_files)
+    include_thread_replies = _parse_bool(include_thread_replies)
+
+    if (
+        not user_ids
+        and keyword is None
+        and pattern is None
+        and min_reactions is None
+        and has_files is None
+        and include_thread_replies is not False
+    ):
+        return None
+
+    def match(message):
+        if user_ids and message.get("user") not in user_ids:
+            return False
+        if include_thread_replies is False and _is_thread_reply(message):
+            return False
+        if has_files is not None and bool(message.get("files")) != has_files:
+            return False
+        if min_reactions is not None:
+            count = sum(len(r.get("users", [])) for r in message.get("reactions", []))
+            if count < min_reactions:
+                return False
+        text = message.get("text", "")
+        if keyword is not None and keyword not in text.lower():
+            return False
+        if pattern is not None and not pattern.search(text):
+            return False
+        return True
+
+    return match
+
+
+def format_message(client, message, jst, deadline, lookup_user=True, user_names=None):
+    """
+    Slack APIから取得したメッセージを、レスポンス用の形式に整形します。
+    lookup_user が False の場合はユーザー情報を取得せず、ユーザー名にIDを使います。
+    user_names（ユーザーID → 名前）を渡すと、取得したユーザー名をキャッシュして
+    同じユーザーについてはAPIを呼び出しません。
+    """
+    user_names = {} if user_names is None else user_names
+    message_ts = message["ts"]
+    user_id = message.get("user", "unknown")
+    text = message.get("text", "")
+
+    # タイムスタンプを日時に変換
+    message_datetime = datetime.fromtimestamp(float(message_ts), tz=jst)
+    formatted_time = message_datetime.strftime("%Y/%m/%d %H:%M:%S")
+
+    # ユーザー情報を取得（可能であれば）
+    user_name = user_names.get(user_id, user_id)
+    try:
+        if lookup_user and user_id != "unknown" and user_id not in user_names:
+            client.timeout = deadline.timeout(SLACK_TIMEOUT_SECONDS)
+            user_info = client.users_info(user=user_id)
+            user_name = user_info["user"]["real_name"] or user_info["user"]["name"]
+            user_names[user_id] = user_name
+            # APIレート制限を避けるため少し待機（期限を超えない範囲で）
+            deadline.sleep(0.5)
+    except (SlackApiError, OSError):
+        # ユーザー情報が取得できない（タイムアウトを含む）場合はIDをそのまま使用
+        pass
+
+    message_data = {
+        "timestamp": message_ts,
+        "datetime": formatted_time,
+        "user_id": user_id,
+        "user_name": user_name,
+        "text": text,
+        "has_reactions": bool(message.get("reactions")),
+        "reaction_count": sum(
+            len(r.get("users", [])) for r in message.get("reactions", [])
+        ),
+    }
+
+    # スレッドメッセージの場合（親メッセージは返信として扱わない）
+    message_data["is_thread_reply"] = _is_thread_reply(message)
+    if message.get("thread_ts"):
+        message_data["thread_ts"] = message["thread_ts"]
+
+    # ファイルが添付されている場合
+    if message.get("files"):
+        message_data["has_files"] = True
+        message_data["file_count"] = len(message["files"])
+    else:
+        message_data["has_files"] = False
+        message_data["file_count"] = 0
+
+    print(
+        f"📝 [{formatted_time}] {user_name}: {text[:50]}{'...' if len(text) > 50 else ''}"
+    )
+    return message_data
+
+
+def fetch_slack_messages(
+    token,
+    channel_id,
+    minutes,
+    message_filter=None,
+    deadline=None,
+    shards=1,
+    exporter=None,
+):
     """
     指定されたSlackチャンネルのメッセージを取得して出力します。
     Lambda用に結果も返します。
+    message_filter が指定された場合は、条件に合うメッセージのみを処理します。
+    deadline の期限が迫った場合は処理を打ち切り、途中までの結果に truncated を付けて返します。
+    shards に 2 以上または "auto" を指定すると、期間を分割して履歴を並列に取得します。
+    exporter が指定された場合は、結果を返さずに取得しながらNDJSONで書き出します。
     """
+    deadline = deadline or Deadline()
     result = {
         "channel_id": channel_id,
         "minutes": minutes,
         "messages": [],
         "summary": {},
+        "truncated": False,
     }
 
     if not token:
@@ -31,7 +231,7 @@ def fetch_slack_messages(token, channel_id, minutes):
         result["error"] = error_msg
         return result
 
-    client = WebClient(token=token)
+    client = WebClient(token=token, timeout=deadline.timeout(SLACK_TIMEOUT_SECONDS))
 
     # タイムゾーンを考慮した期間設定（JST）
     jst = timezone(timedelta(hours=+9))
@@ -55,82 +255,82 @@ def fetch_slack_messages(token, channel_id, minutes):
 
     try:
         # conversations.history APIで指定期間のメッセージを取得
+        # 絞り込み条件に合わないメッセージは取得しながら除外する
+        # （ユーザー情報の取得や整形の前に行うことで、処理量を削減する）
         print("📜 メッセージ履歴を取得中...")
-        history_response = client.conversations_history(
-            channel=channel_id,
-            latest=str(latest_ts),
-            oldest=str(oldest_ts),
-            limit=200,  # 取得するメッセージ数の上限
+        # 取得したメッセージを整形する時間を残して、履歴の取得を打ち切る
+        scanner = HistoryScanner(
+            token,
+            channel_id,
+            deadline=deadline,
+            reserve=min(
+                deadline.remaining() * FORMAT_RESERVE_RATIO, FORMAT_RESERVE_MAX_SECONDS
+            ),
         )
-        messages = history_response.get("messages", [])
-
-        if not messages:
-            msg = "指定された期間にメッセージは見つかりませんでした。"
-            print(msg)
-            result["summary"]["message_count"] = 0
-            return result
-
-        print(f"👍 {len(messages)}件のメッセージが見つかりました。")
-        print("-" * 40)
-
-        result["summary"]["message_count"] = len(messages)
+        counts = {"message_count": 0, "matched_count": 0}
+        # 走査したメッセージは絞り込み前に1時間ごとの集計にも使う
+        rollup_builder = HourlyRollupBuilder()
+        scan_state = {"completed": False}
+
+        def matched_messages():
+            for message in scanner.scan(oldest_ts, latest_ts, shards=shards):
+                counts["message_count"] += 1
+                rollup_builder.add(message)
+                if message_filter is None or message_filter(message):
+                    counts["matched_count"] += 1
+                    yield message
+            scan_state["completed"] = True
+
+        if exporter is None:
+            # シャードごとに取得した結果を新しい順に並べ直す
+            messages = sorted(
+                matched_messages(), key=lambda m: float(m["ts"]), reverse=True
+            )
+            print(f"👍 {counts['message_count']}件のメッセージが見つかりました。")
+            if message_filter:
+                print(f"🔎 絞り込み後: {len(messages)}件")
+            print("-" * 40)
+        else:
+            # 書き出しモードでは全件をメモリに持たず、取得しながら書き出す（順不同）
+            messages = matched_messages()
 
         # メッセージの詳細を処理
+        # ユーザー名はこの呼び出しの間キャッシュし、ユーザー情報の取得はユーザーごとに1回にする
+        user_names = {}
+        lookup_user = True
         for message in messages:
-            message_ts = message["ts"]
-            user_id = message.get("user", "unknown")
-            text = message.get("text", "")
-
-            # タイムスタンプを日時に変換
-            message_datetime = datetime.fromtimestamp(float(message_ts), tz=jst)
-            formatted_time = message_datetime.strftime("%Y/%m/%d %H:%M:%S")
-
-            # ユーザー情報を取得（可能であれば）
-            user_name = user_id
-            try:
-                if user_id != "unknown":
-                    user_info = client.users_info(user=user_id)
-                    user_name = (
-                        user_info["user"]["real_name"] or user_info["user"]["name"]
-                    )
-                    # APIレート制限を避けるため少し待機
-                    time.sleep(0.5)
-            except SlackApiError:
-                # ユーザー情報が取得できない場合はIDをそのまま使用
-                pass
-
-            message_data = {
-                "timestamp": message_ts,
-                "datetime": formatted_time,
-                "user_id": user_id,
-                "user_name": user_name,
-                "text": text,
-                "has_reactions": bool(message.get("reactions")),
-                "reaction_count": sum(
-                    len(r.get("users", [])) for r in message.get("reactions", [])
-                ),
-            }
-
-            # スレッドメッセージの場合
-            if message.get("thread_ts"):
-                message_data["is_thread_reply"] = True
-                message_data["thread_ts"] = message["thread_ts"]
+            # Lambdaの実行時間が尽きる前に、残りのメッセージはユーザー情報を取得せずに整形する
+            # （取得済みのメッセージは捨てずに結果に含める）
+            if lookup_user and deadline.expired():
+                lookup_user = False
+                print("⏱️ 実行時間の上限が近いため、ユーザー情報の取得を省略します。")
+
+            message_data = format_message(
+                client,
+                message,
+                jst,
+                deadline,
+                lookup_user=lookup_user,
+                user_names=user_names,
+            )
+            if exporter is None:
+                result["messages"].append(message_data)
             else:
-                message_data["is_thread_reply"] = False
+                exporter.write(message_data)
 
-            # ファイルが添付されている場合
-            if message.get("files"):
-                message_data["has_files"] = True
-                message_data["file_count"] = len(message["files"])
-            else:
-                message_data["has_files"] = False
-                message_data["file_count"] = 0
+        # 期間内を最後まで走査できた場合のみ、終了済みの時間の集計を保存する
+        if scan_state["completed"] and not scanner.truncated:
+            save_rollups(channel_id, rollup_builder, oldest_ts, latest_ts)
 
-            result["messages"].append(message_data)
+        result["truncated"] = result["truncated"] or scanner.truncated
+        result["summary"].update(counts)
+        result["summary"]["shard_count"] = scanner.shard_count
+        result["summary"]["page_count"] = scanner.page_count
 
-            print(
-                f"📝 [{formatted_time}] {user_name}: {text[:50]}{'...' if len(text) > 50 else ''}"
-            )
+        if not counts["message_count"]:
+            msg = "指定された期間にメッセージは見つかりませんでした。"
+            print(msg)
+            return result
 
         print("\n" + "-" * 40)
         print("✅ 処理が完了しました。")
@@ -163,6 +363,9 @@ def lambda_handler(event, context):
     """
     Lambda関数のメインハンドラー
     """
+    # Lambdaの残り実行時間から、外部呼び出しに使える期限を決める
+    deadline = Deadline.from_context(context)
+
     try:
         # 環境変数から設定を取得
         slack_bot_token = os.environ.get("SLACK_BOT_TOKEN")
@@ -178,11 +381,97 @@ def lambda_handler(event, context):
                 ),
             }
 
-        # eventから期間を設定できるようにする（デフォルトは30分）
-        minutes = event.get("minutes", MINUTES_TO_FETCH)
+        # API Gateway経由の場合はクエリパラメータからも設定を受け取る
+        params = dict(event.get("queryStringParameters") or {})
+        params.update({k: v for k, v in event.items() if k != "queryStringParameters"})
+
+        # 絞り込み条件（ユーザーID、キーワード/正規表現、リアクション数、ファイル有無、スレッド返信）
+        try:
+            # eventから期間を設定できるようにする（デフォルトは30分）
+            minutes = int(params.get("minutes", MINUTES_TO_FETCH))
+
+            # 期間を分割して並列に取得する場合のシャード数（数値または "auto"）
+            shards = params.get("shards", 1)
+            if shards != "auto":
+                shards = int(shards)
+
+            message_filter = build_message_filter(
+                user_ids=params.get("user_ids"),
+                keyword=params.get("keyword"),
+                regex=params.get("regex"),
+                min_reactions=params.get("min_reactions"),
+                has_files=params.get("has_files"),
+                include_thread_replies=params.get("include_thread_replies", True),
+            )
+        except (re.error, ValueError) as e:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": f"Invalid parameter: {str(e)}"}),
+            }
+
+        # mode=rollup の場合は、保存済みの1時間ごとの集計を組み合わせて
+        # メッセージ数・リアクション数・上位の投稿者などを返す（不足分と現在の時間のみ取得する）
+        if params.get("mode") == "rollup":
+            summary = query_recent_rollups(
+                get_rollup_store(),
+                HistoryScanner(slack_bot_token, channel_id, deadline=deadline),
+                channel_id,
+                minutes,
+                shards=shards,
+            )
+            return {
+                "statusCode": 200,
+                "headers": {"X-Truncated": str(summary["truncated"]).lower()},
+                "body": json.dumps(summary, ensure_ascii=False),
+            }
+
+        # export を指定した場合は、結果をNDJSONでオブジェクトストレージに書き出し、
+        # レスポンスには書き出し先と件数だけを返す（gzip で圧縮も可能）
+        exporter = None
+        if _parse_bool(params.get("export")):
+            exporter = create_exporter(
+                f"messages/{channel_id}",
+                compress=bool(_parse_bool(params.get("gzip"))),
+                deadline=deadline,
+            )
 
         # Slackからメッセージ情報を取得
-        result = fetch_slack_messages(slack_bot_token, channel_id, minutes)
+        try:
+            result = fetch_slack_messages(
+                slack_bot_token,
+                channel_id,
+                minutes,
+                message_filter=message_filter,
+                deadline=deadline,
+                shards=shards,
+                exporter=exporter,
+            )
+        except Exception:
+            if exporter:
+                exporter.abort()
+            raise
+
+        if exporter:
+            if "error" in result:
+                exporter.abort()
+                return {
+                    "statusCode": 500,
+                    "body": json.dumps({"error": result["error"]}),
+                }
+            pointer = exporter.close()
+            return {
+                "statusCode": 200,
+                "headers": {"X-Truncated": str(result["truncated"]).lower()},
+                "body": json.dumps(
+                    {
+                        "export": pointer,
+                        "period": result.get("period"),
+                        "summary": result["summary"],
+                        "truncated": result["truncated"],
+                    },
+                    ensure_ascii=False,
+                ),
+            }
 
         # APIエラーなどがresultに含まれている場合はエラーとして返す
         if "error" in result and not result.get("messages"):
@@ -195,8 +484,10 @@ def lambda_handler(event, context):
         messages_list = result.get("messages", [])
 
         # 変更点: レスポンスボディにはmessagesのリストのみを含める
+        # 時間切れで途中までの結果になった場合は X-Truncated ヘッダーで知らせる
         return {
             "statusCode": 200,
+            "headers": {"X-Truncated": str(result.get("truncated", False)).lower()},
             "body": json.dumps(
                 messages_list,
                 ensure_ascii=False,  # 日本語のテキストが文字化けしないように設定
@@ -218,6 +509,12 @@ if __name__ == "__main__":
     # export MAIN_CHANNEL_ID="C12345678"
 
     test_event = {"minutes": 30}
+    # 絞り込みの例:
+    # test_event = {"minutes": 30, "user_ids": "U123,U456", "min_reactions": 1}
+    # 書き出しの例（EXPORT_BACKEND=local で /tmp/exports に書き出す）:
+    # test_event = {"minutes": 10080, "shards": "auto", "export": True, "gzip": True}
+    # 1時間ごとの集計を使う例:
+    # test_event = {"minutes": 10080, "mode": "rollup"}
     test_context = {}
     result = lambda_handler(test_event, test_context)
     print("--- Lambda Response ---")
@@ -0,0 +1,98 @@
+import os
+import re
+import sys
+
+import pytest
+
+# 複数の関数で使う共通モジュール（デプロイ時に関数のディレクトリにコピーされる）
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"),
+)
+
+from get_messages.app import build_message_filter  # noqa: E402
+
+
+def message(ts="1.000100", user="U1", text="", **fields):
+    return {"ts": ts, "user": user, "text": text, **fields}
+
+
+def test_no_conditions_returns_none():
+    assert build_message_filter() is None
+    assert build_message_filter(user_ids="", keyword="", min_reactions="") is None
+
+
+@pytest.mark.parametrize("user_ids", ["U1, U3", ["U1", "U3"]])
+def test_user_ids_from_list_or_comma_separated_string(user_ids):
+    match = build_message_filter(user_ids=user_ids)
+    assert match(message(user="U1"))
+    assert match(message(user="U3"))
+    assert not match(message(user="U2"))
+
+
+def test_keyword_is_a_case_insensitive_substring():
+    match = build_message_filter(keyword="Release")
+    assert match(message(text="the release is out"))
+    assert not match(message(text="r.e.l.e.a.s.e"))
+    # 正規表現としては解釈しない
+    assert not build_message_filter(keyword="v1.*")(message(text="v1.2"))
+    assert build_message_filter(keyword="v1.*")(message(text="see v1.* notes"))
+
+
+def test_regex_is_case_sensitive_search():
+    match = build_message_filter(regex=r"v\d+\.\d+")
+    assert match(message(text="shipped v2.10 today"))
+    assert not match(message(text="shipped v2 today"))
+    assert not build_message_filter(regex="Release")(message(text="release"))
+
+
+def test_invalid_regex_raises():
+    with pytest.raises(re.error):
+        build_message_filter(regex="(")
+
+
+def test_min_reactions_counts_reacting_users():
+    match = build_message_filter(min_reactions="3")
+    reactions = [
+        {"name": "+1", "users": ["U2", "U3"]},
+        {"name": "tada", "users": ["U4"]},
+    ]
+    assert match(message(reactions=reactions))
+    assert not match(message(reactions=reactions[:1]))
+    assert not match(message())
+
+
+@pytest.mark.parametrize(
+    "has_files, with_files, without_files",
+    [("true", True, False), ("false", False, True)],
+)
+def test_has_files(has_files, with_files, without_files):
+    match = build_message_filter(has_files=has_files)
+    assert match(message(files=[{"id": "F1"}])) is with_files
+    assert match(message(files=[])) is without_files
+    assert match(message()) is without_files
+
+
+def test_excluding_thread_replies_keeps_parents_and_drops_broadcast_replies():
+    match = build_message_filter(include_thread_replies="false")
+    parent = message(ts="1.000100", thread_ts="1.000100", reply_count=3)
+    broadcast_reply = message(
+        ts="1.000200", thread_ts="1.000100", subtype="thread_broadcast"
+    )
+    assert match(parent)
+    assert not match(broadcast_reply)
+    assert match(message(ts="1.000300"))
+
+
+def test_thread_replies_are_included_by_default():
+    match = build_message_filter(user_ids="U1")
+    assert match(message(ts="1.000200", thread_ts="1.000100"))
+
+
+def test_conditions_are_combined():
+    match = build_message_filter(user_ids="U1", keyword="deploy", min_reactions=1)
+    reactions = [{"name": "+1", "users": ["U2"]}]
+    assert match(message(user="U1", text="Deploy done", reactions=reactions))
+    assert not match(message(user="U2", text="Deploy done", reactions=reactions))
+    assert not match(message(user="U1", text="Deploy done"))
+    assert not match(message(user="U1", text="done", reactions=reactions))
@@ -4,25 +4,78 @@
 
 import os
 import json
-import time
 from datetime import datetime, timedelta, timezone
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
 
+from deadline import Deadline
+from export import create_exporter
+from rollup import (
+    HourlyRollupBuilder,
+    create_rollup_store,
+    query_recent_rollups,
+    save_scanned_rollups,
+)
+from slack_history import HistoryScanner
+
 # 遡ってメッセージを取得する期間（分数）
 MINUTES_TO_FETCH = 120
 
+# Slack API呼び出し1回あたりのタイムアウト上限（秒）
+SLACK_TIMEOUT_SECONDS = 30
+
+# 1時間ごとの集計の保存先（初回の呼び出し時に作成する）
+_rollup_store = None
+
+
+def get_rollup_store():
+    global _rollup_store
+    if _rollup_store is None:
+        _rollup_store = create_rollup_store()
+    return _rollup_store
+
+
+def save_rollups(channel_id, builder, oldest_ts, latest_ts):
+    """
+    走査したメッセージの1時間ごとの集計を保存します。
+    集計の保存に失敗しても、本来の取得結果には影響させません。
+    """
+    try:
+        saved = save_scanned_rollups(
+            get_rollup_store(), channel_id, builder, oldest_ts, latest_ts
+        )
+        print(f"📊 {saved}時間分の集計を保存しました。")
+    except Exception as e:
+        print(f"Failed to save rollups: {e}")
+
 
-def fetch_slack_reactions(token, channel_id, minutes):
+def _parse_bool(value):
+    """
+    "true" / "1" / "yes" などの文字列も真偽値として解釈します。
+    クエリパラメータ経由では文字列で渡されるため。
+    """
+    if value is None or isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("true", "1", "yes", "on")
+
+
+def fetch_slack_reactions(
+    token, channel_id, minutes, deadline=None, shards=1, exporter=None
+):
     """
     指定されたSlackチャンネルのリアクションを取得して出力します。
     Lambda用に結果も返します。
+    deadline の期限が迫った場合は処理を打ち切り、途中までの結果に truncated を付けて返します。
+    shards に 2 以上または "auto" を指定すると、期間を分割して履歴を並列に取得します。
+    exporter が指定された場合は、結果を返さずに取得しながらNDJSONで書き出します。
     """
+    deadline = deadline or Deadline()
     result = {
         "channel_id": channel_id,
         "minutes": minutes,
         "reactions": [],
         "summary": {},
+        "truncated": False,
     }
 
     if not token:
@@ -31,7 +84,7 @@ def fetch_slack_reactions(token, channel_id, minutes):
         result["error"] = error_msg
         return result
 
-    client = WebClient(token=token)
+    client = WebClient(token=token, timeout=deadline.timeout(SLACK_TIMEOUT_SECONDS))
 
     # タイムゾーンを考慮した期間設定（JST）
     jst = timezone(timedelta(hours=+9))
@@ -55,38 +108,32 @@ def fetch_slack_reactions(token, channel_id, minutes):
 
     try:
         # 1. conversations.history APIで指定期間のメッセージを取得
+        # 全件をメモリに持たず、取得しながらリアクションを処理する
         print("📜 メッセージ履歴を取得中...")
-        history_response = client.conversations_history(
-            channel=channel_id,
-            latest=str(latest_ts),
-            oldest=str(oldest_ts),
-            limit=200,  # 取得するメッセージ数の上限
-        )
-        messages = history_response.get("messages", [])
-
-        if not messages:
-            msg = "指定された期間にメッセージは見つかりませんでした。"
-            print(msg)
-            result["summary"]["message_count"] = 0
-            result["summary"]["reaction_count"] = 0
-            return result
-
-        print(
-            f"👍 {len(messages)}件のメッセージが見つかりました。リアクションを取得します。"
-        )
-        print("-" * 40)
-
-        result["summary"]["message_count"] = len(messages)
+        scanner = HistoryScanner(token, channel_id, deadline=deadline)
+        message_count = 0
         reaction_count = 0
+        # 走査したメッセージは1時間ごとの集計にも使う
+        rollup_builder = HourlyRollupBuilder()
+        scan_completed = False
 
         # 2. 取得した各メッセージに対してリアクション情報を取得
-        for message in messages:
+        for message in scanner.scan(oldest_ts, latest_ts, shards=shards):
+            message_count += 1
+            rollup_builder.add(message)
             # リアクションがついているメッセージのみ処理
             if message.get("reactions"):
+                # Lambdaの実行時間が尽きる前に打ち切り、ここまでの結果を返す
+                if deadline.expired():
+                    result["truncated"] = True
+                    print("⏱️ 実行時間の上限が近いため、処理を打ち切ります。")
+                    break
+
                 message_ts = message["ts"]
 
                 try:
                     # reactions.get APIでリアクションの詳細を取得
+                    client.timeout = deadline.timeout(SLACK_TIMEOUT_SECONDS)
                     reactions_response = client.reactions_get(
                         channel=channel_id, timestamp=message_ts, full=True
                     )
@@ -101,17 +148,20 @@ def fetch_slack_reactions(token, channel_id, minutes):
                             users = reaction["users"]
                             print(f"  - :{name}: by {', '.join(users)}")
 
-                            result["reactions"].append(
-                                {
-                                    "name": name,
-                                    "users": users,
-                                    "count": len(users),
-                                }
-                            )
+                            reaction_data = {
+                                "name": name,
+                                "users": users,
+                                "count": len(users),
+                            }
+                            if exporter is None:
+                                result["reactions"].append(reaction_data)
+                            else:
+                                exporter.write(reaction_data)
                             reaction_count += len(users)
 
                     # Slack APIのレートリミットを避けるための待機 (Tier3: 50+ req/min)
-                    time.sleep(1.2)
+                    # 期限を超えない範囲で待機する
+                    deadline.sleep(1.2)
 
                 except SlackApiError as e:
                     error_msg = f"リアクション取得エラー: {e.response['error']}"
@@ -121,7 +171,34 @@ def fetch_slack_reactions(token, channel_id, minutes):
                         result["error"] = []
                     result["error"].append(error_msg)
 
+                except OSError as e:
+                    # タイムアウトなどの通信エラーでも、ここまでの結果は失わないようにする
+                    error_msg = f"リアクション取得エラー: {e}"
+                    print(f"  ❌ {error_msg}")
+                    if "error" not in result:
+                        result["error"] = []
+                    result["error"].append(error_msg)
+        else:
+            scan_completed = True
+
+        # 期間内を最後まで走査できた場合のみ、終了済みの時間の集計を保存する
+        if scan_completed and not scanner.truncated:
+            save_rollups(channel_id, rollup_builder, oldest_ts, latest_ts)
+
+        result["truncated"] = result["truncated"] or scanner.truncated
+        result["summary"]["message_count"] = message_count
         result["summary"]["reaction_count"] = reaction_count
+        result["summary"]["shard_count"] = scanner.shard_count
+        result["summary"]["page_count"] = scanner.page_count
+
+        if not message_count:
+            msg = "指定された期間にメッセージは見つかりませんでした。"
+            print(msg)
+            return result
+
+        print(
+            f"👍 {message_count}件のメッセージから{reaction_count}件のリアクションが見つかりました。"
+        )
         print("\n" + "-" * 40)
         print("✅ 処理が完了しました。")
 
@@ -153,6 +230,9 @@ def lambda_handler(event, context):
     """
     Lambda関数のメインハンドラー
     """
+    # Lambdaの残り実行時間から、外部呼び出しに使える期限を決める
+    deadline = Deadline.from_context(context)
+
     try:
         # 環境変数から設定を取得
         slack_bot_token = os.environ.get("SLACK_BOT_TOKEN")
@@ -168,11 +248,87 @@ def lambda_handler(event, context):
                 ),
             }
 
+        # API Gateway経由の場合はクエリパラメータからも設定を受け取る
+        params = dict(event.get("queryStringParameters") or {})
+        params.update({k: v for k, v in event.items() if k != "queryStringParameters"})
+
         # eventから期間を設定できるようにする（デフォルトは30分）
-        minutes = event.get("minutes", MINUTES_TO_FETCH)
+        try:
+            minutes = int(params.get("minutes", MINUTES_TO_FETCH))
+            # 期間を分割して並列に取得する場合のシャード数（数値または "auto"）
+            shards = params.get("shards", 1)
+            if shards != "auto":
+                shards = int(shards)
+        except ValueError as e:
+            return {
+                "statusCode": 400,
+                "body": json.dumps({"error": f"Invalid parameter: {str(e)}"}),
+            }
+
+        # mode=rollup の場合は、保存済みの1時間ごとの集計を組み合わせて
+        # リアクション数（受けた数・付けた数）や上位のメッセージなどを返す（不足分と現在の時間のみ取得する）
+        if params.get("mode") == "rollup":
+            summary = query_recent_rollups(
+                get_rollup_store(),
+                HistoryScanner(slack_bot_token, channel_id, deadline=deadline),
+                channel_id,
+                minutes,
+                shards=shards,
+            )
+            return {
+                "statusCode": 200,
+                "headers": {"X-Truncated": str(summary["truncated"]).lower()},
+                "body": json.dumps(summary, ensure_ascii=False),
+            }
+
+        # export を指定した場合は、結果をNDJSONでオブジェクトストレージに書き出し、
+        # レスポンスには書き出し先と件数だけを返す（gzip で圧縮も可能）
+        exporter = None
+        if _parse_bool(params.get("export")):
+            exporter = create_exporter(
+                f"reactions/{channel_id}",
+                compress=bool(_parse_bool(params.get("gzip"))),
+                deadline=deadline,
+            )
 
         # Slackからリアクション情報を取得
-        result = fetch_slack_reactions(slack_bot_token, channel_id, minutes)
+        try:
+            result = fetch_slack_reactions(
+                slack_bot_token,
+                channel_id,
+                minutes,
+                deadline=deadline,
+                shards=shards,
+                exporter=exporter,
+            )
+        except Exception:
+            if exporter:
+                exporter.abort()
+            raise
+
+        if exporter:
+            # 個別のリアクション取得エラー（リスト）は途中結果として書き出しを完了する
+            if isinstance(result.get("error"), str):
+                exporter.abort()
+                return {
+                    "statusCode": 500,
+                    "body": json.dumps({"error": result["error"]}),
+                }
+            pointer = exporter.close()
+            return {
+                "statusCode": 200,
+                "headers": {"X-Truncated": str(result["truncated"]).lower()},
+                "body": json.dumps(
+                    {
+                        "export": pointer,
+                        "period": result.get("period"),
+                        "summary": result["summary"],
+                        "truncated": result["truncated"],
+                        "errors": result.get("error", []),
+                    },
+                    ensure_ascii=False,
+                ),
+            }
 
         # resultにエラーキーが含まれているかチェック
         if "error" in result and "reactions" not in result:
@@ -185,8 +341,10 @@ def lambda_handler(event, context):
         reactions_list = result.get("reactions", [])
 
         # 変更点：レスポンスのbodyにはreactionsのリストのみを含める
+        # 時間切れで途中までの結果になった場合は X-Truncated ヘッダーで知らせる
         return {
             "statusCode": 200,
+            "headers": {"X-Truncated": str(result.get("truncated", False)).lower()},
             "body": json.dumps(reactions_list, ensure_ascii=False),
         }
 
@@ -205,6 +363,10 @@ if __name__ == "__main__":
     # export MAIN_CHANNEL_ID="C12345678"
 
     test_event = {"minutes": 30}
+    # 書き出しの例（EXPORT_BACKEND=local で /tmp/exports に書き出す）:
+    # test_event = {"minutes": 10080, "shards": "auto", "export": True, "gzip": True}
+    # 1時間ごとの集計を使う例:
+    # test_event = {"minutes": 10080, "mode": "rollup"}
     test_context = {}
     result = lambda_handler(test_event, test_context)
     print("--- Lambda Response ---")
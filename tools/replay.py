@@ -0,0 +1,474 @@
+##################################################
+# 記録したイベント（capture.py）をローカルで再生する負荷試験ツール
+#
+# dify_slack_bot_mention と dify_slack_bot_processor のハンドラーを同じプロセス内で呼び出し、
+# Slack・SQS・Difyはローカルの代替（遅延を指定可能）に置き換えます。
+# スループット・キューの滞留時間・レイテンシのパーセンタイルを出力します。
+#
+# 使い方:
+#   python tools/replay.py capture.ndjson --speedup 10
+#   python tools/replay.py capture.ndjson --qps 20 --loops 5 --dify-latency 3000
+##################################################
+
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import importlib.util
+from types import SimpleNamespace
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 複数の関数で使う共通モジュール（デプロイ時に各関数のディレクトリにコピーされる）
+sys.path.insert(0, os.path.join(ROOT, "common"))
+LOG_PREFIX = "CAPTURE "
+
+DIFY_API_URL = "http://dify.local/v1/workflows/run"
+QUEUE_ARN = "arn:aws:sqs:ap-northeast-1:000000000000:replay"
+
+
+def load_captures(paths):
+    """
+    NDJSONファイル（CloudWatch Logsから書き出した "CAPTURE " 付きの行も可）を読み込みます。
+    """
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if LOG_PREFIX in line:
+                    line = line[line.index(LOG_PREFIX) + len(LOG_PREFIX) :]
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["captured_at"])
+    return records
+
+
+def load_handler(directory, module_name):
+    """
+    Lambda関数のディレクトリの app.py を、名前が衝突しないように読み込みます。
+    """
+    path = os.path.join(ROOT, directory)
+    sys.path.insert(0, path)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            module_name, os.path.join(path, "app.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        sys.path.remove(path)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return round(values[index], 1)
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p90": percentile(values, 90),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 1) if values else None,
+    }
+
+
+class FakeContext:
+    def __init__(self, timeout_ms, function_name):
+        self.function_name = function_name
+        self._deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
+
+
+class FakeResponse:
+    def __init__(self, payload, status=200):
+        self.status = status
+        self.data = (
+            payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        )
+
+
+class FakeConnectionPool:
+    """
+    urllib3の接続プールの代わり。一度リクエストしたホストには接続済みのコネクションが1つある状態にします。
+    （warmup.idle_connections が参照する pool.queue の形に合わせている）
+    """
+
+    def __init__(self, connected):
+        self.pool = SimpleNamespace(
+            queue=[SimpleNamespace(sock=object())] if connected else []
+        )
+
+
+class FakeHTTP:
+    """
+    urllib3.PoolManager の代わりに、SlackとDifyの応答を遅延付きで返します。
+    """
+
+    def __init__(self, slack_latency_ms, dify_latency_ms, jitter):
+        self.slack_latency_ms = slack_latency_ms
+        self.dify_latency_ms = dify_latency_ms
+        self.jitter = jitter
+        self._ts = 0
+        self._hosts = set()
+        self._lock = threading.Lock()
+
+    def _sleep(self, latency_ms):
+        time.sleep(
+            max(latency_ms * random.uniform(1 - self.jitter, 1 + self.jitter), 0) / 1000
+        )
+
+    def connection_from_url(self, url):
+        return FakeConnectionPool(urlparse(url).netloc in self._hosts)
+
+    def request(self, method, url, **kwargs):
+        with self._lock:
+            self._hosts.add(urlparse(url).netloc)
+        if url.startswith(DIFY_API_URL):
+            self._sleep(self.dify_latency_ms)
+            return FakeResponse(b'data: {"answer": "replayed answer"}\n')
+        self._sleep(self.slack_latency_ms)
+        with self._lock:
+            self._ts += 1
+            ts = f"{time.time():.0f}.{self._ts:06d}"
+        return FakeResponse({"ok": True, "ts": ts})
+
+
+class FakeSQS:
+    """
+    SQSの代わりのメモリ上のキュー。送信時刻を記録してキューの滞留時間を測ります。
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        # 送信されたメッセージ数（再配信は含まない）。全件の処理が終わったかどうかの判定に使う
+        self.enqueued = 0
+        # change_message_visibility で指定された、次の再配信までの秒数（受信ハンドルごと）
+        self.visibility = {}
+        self._id = 0
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, **kwargs):
+        with self._lock:
+            self._id += 1
+            message_id = f"replay-{self._id}"
+        self.enqueue(
+            {
+                "messageId": message_id,
+                "body": MessageBody,
+                "attributes": {"SentTimestamp": str(int(time.time() * 1000))},
+            },
+            time.time(),
+        )
+        return {"MessageId": message_id}
+
+    def enqueue(self, record, enqueued_at):
+        record = dict(
+            record,
+            receiptHandle=record["messageId"],
+            eventSourceARN=QUEUE_ARN,
+        )
+        with self._lock:
+            self.enqueued += 1
+        self.put(record, enqueued_at)
+
+    def put(self, record, enqueued_at):
+        self.queue.put((record, enqueued_at))
+
+    def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+        with self._lock:
+            self.visibility[ReceiptHandle] = VisibilityTimeout
+
+    def visibility_timeout(self, record, default):
+        with self._lock:
+            return self.visibility.pop(record["receiptHandle"], default)
+
+    def get_queue_attributes(self, **kwargs):
+        return {}
+
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.http = FakeHTTP(args.slack_latency, args.dify_latency, args.jitter)
+        self.sqs = FakeSQS()
+        self.mention_latencies = []
+        self.processor_latencies = []
+        self.queue_lags = []
+        self.end_to_end = []
+        self.redeliveries = 0
+        self.sent = 0
+        self.processed = 0
+        self._last_processed_at = None
+        self._received_at = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-replay")
+        os.environ.setdefault("DIFY_API_KEY", "replay")
+        os.environ["DIFY_API_URL"] = DIFY_API_URL
+        os.environ.setdefault("SQS_QUEUE_URL", "https://sqs.local/replay")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "ap-northeast-1")
+        os.environ.setdefault("IDEMPOTENCY_BACKEND", "memory")
+
+        self.mention = load_handler("dify_slack_bot_mention", "replay_mention_app")
+        self.processor = load_handler(
+            "dify_slack_bot_processor", "replay_processor_app"
+        )
+        self.mention.http = self.http
+        self.processor.http = self.http
+
+        sqs = self.sqs
+        original = self.mention.Deadline.boto_client
+
+        def boto_client(deadline, service_name, cap=10):
+            if service_name == "sqs":
+                return sqs
+            return original(deadline, service_name, cap)
+
+        self.mention.Deadline.boto_client = boto_client
+
+    def _unique(self, record, loop):
+        """
+        同じイベントを繰り返し再生しても冪等性の台帳で捨てられないように、IDを付け替えます。
+        """
+        event = json.loads(json.dumps(record["event"]))
+        suffix = f"-replay{loop}"
+        body = json.loads(event.get("body") or "{}")
+        if record["kind"] == "apigw":
+            if body.get("event_id"):
+                body["event_id"] += suffix
+            if body.get("event", {}).get("client_msg_id"):
+                body["event"]["client_msg_id"] += suffix
+        elif body.get("idempotency_key"):
+            body["idempotency_key"] += suffix
+        event["body"] = json.dumps(body, ensure_ascii=False)
+        if "messageId" in event:
+            event["messageId"] += suffix
+        return event
+
+    def _schedule(self, records):
+        """
+        各イベントを送る時刻（開始からの秒数）を決めます。
+        --qps を指定した場合は一定間隔、それ以外は記録時の間隔を --speedup で縮めます。
+        """
+        schedule = []
+        offset = 0.0
+        for loop in range(self.args.loops):
+            first = records[0]["captured_at"]
+            for i, record in enumerate(records):
+                if self.args.qps:
+                    at = (loop * len(records) + i) / self.args.qps
+                else:
+                    at = offset + (record["captured_at"] - first) / self.args.speedup
+                schedule.append((at, record, loop))
+            if not self.args.qps:
+                offset = schedule[-1][0] + 1 / self.args.speedup
+        return schedule
+
+    def _send_mention(self, event):
+        started = time.monotonic()
+        body = json.loads(event["body"])
+        key = body.get("event", {}).get("client_msg_id") or body.get("event_id")
+        with self._lock:
+            self._received_at[key] = time.time()
+        self.mention.lambda_handler(event, FakeContext(3000, "replay-mention"))
+        with self._lock:
+            self.mention_latencies.append((time.monotonic() - started) * 1000)
+
+    def _consume(self):
+        """
+        キューからバッチを取り出して実行係を呼び出します（SQSのイベントソースマッピングの代わり）。
+        """
+        while not self._stop.is_set() or not self.sqs.queue.empty():
+            try:
+                batch = [self.sqs.queue.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.args.batch_size:
+                try:
+                    batch.append(self.sqs.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            started = time.time()
+            for _, enqueued_at in batch:
+                self.queue_lags.append((started - enqueued_at) * 1000)
+            event = {"Records": [record for record, _ in batch]}
+            response = self.processor.lambda_handler(
+                event, FakeContext(self.args.processor_timeout, "replay-processor")
+            )
+            finished = time.time()
+
+            failed = {
+                item["itemIdentifier"]
+                for item in (response or {}).get("batchItemFailures", [])
+            }
+            with self._lock:
+                self.processor_latencies.append((finished - started) * 1000)
+                for record, enqueued_at in batch:
+                    if record["messageId"] in failed:
+                        self.redeliveries += 1
+                        threading.Timer(
+                            self.sqs.visibility_timeout(
+                                record, self.args.visibility_timeout
+                            ),
+                            self.sqs.put,
+                            (record, enqueued_at),
+                        ).start()
+                        continue
+                    self.processed += 1
+                    self._last_processed_at = time.monotonic()
+                    body = json.loads(record["body"])
+                    received_at = self._received_at.pop(
+                        body.get("idempotency_key"), None
+                    )
+                    if received_at:
+                        self.end_to_end.append((finished - received_at) * 1000)
+
+    def run(self, records):
+        schedule = self._schedule(records)
+        consumers = [
+            threading.Thread(target=self._consume, daemon=True)
+            for _ in range(self.args.processor_concurrency)
+        ]
+        for consumer in consumers:
+            consumer.start()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.mention_concurrency) as executor:
+            for at, record, loop in schedule:
+                delay = at - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+                event = self._unique(record, loop)
+                self.sent += 1
+                if record["kind"] == "apigw":
+                    executor.submit(self._send_mention, event)
+                else:
+                    self.sqs.enqueue(event, time.time())
+
+        # 受付係の処理はすべて終わっているため、実際にキューに送られた分（再配信待ちを含む）の処理を待つ
+        # （challenge・ボットのメッセージ・重複などキューに送られなかったイベントは待たない）
+        while (
+            self.processed < self.sqs.enqueued
+            and time.monotonic() - started < self.args.drain_timeout
+        ):
+            time.sleep(0.1)
+        self._stop.set()
+        for consumer in consumers:
+            consumer.join()
+        # スループットは最後のメッセージの処理が終わった時点までで計算する
+        elapsed = (self._last_processed_at or time.monotonic()) - started
+
+        return {
+            "events_sent": self.sent,
+            "enqueued": self.sqs.enqueued,
+            "processed": self.processed,
+            "redeliveries": self.redeliveries,
+            "elapsed_seconds": round(elapsed, 2),
+            "throughput_per_second": (
+                round(self.processed / elapsed, 2) if elapsed else None
+            ),
+            "mention_latency_ms": summarize(self.mention_latencies),
+            "queue_lag_ms": summarize(self.queue_lags),
+            "processor_batch_latency_ms": summarize(self.processor_latencies),
+            "end_to_end_ms": summarize(self.end_to_end),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="記録したイベントを再生して負荷を測定します"
+    )
+    parser.add_argument(
+        "captures", nargs="+", help="capture.py が出力したNDJSONファイル"
+    )
+    parser.add_argument(
+        "--speedup", type=float, default=1.0, help="記録時の間隔を何倍速で再生するか"
+    )
+    parser.add_argument(
+        "--qps", type=float, help="記録時の間隔を使わず、一定のQPSで送る"
+    )
+    parser.add_argument(
+        "--kind",
+        choices=["apigw", "sqs"],
+        help="再生する記録の種類（既定は apigw があれば apigw、なければ sqs）",
+    )
+    parser.add_argument(
+        "--loops", type=int, default=1, help="記録を繰り返し再生する回数"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=10, help="実行係に渡すバッチの大きさ"
+    )
+    parser.add_argument(
+        "--processor-concurrency", type=int, default=5, help="実行係の同時実行数"
+    )
+    parser.add_argument(
+        "--mention-concurrency", type=int, default=50, help="受付係の同時実行数"
+    )
+    parser.add_argument(
+        "--slack-latency", type=float, default=150, help="Slack APIの遅延（ミリ秒）"
+    )
+    parser.add_argument(
+        "--dify-latency", type=float, default=2000, help="Difyの遅延（ミリ秒）"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.3, help="遅延のばらつき（0〜1）"
+    )
+    parser.add_argument(
+        "--visibility-timeout",
+        type=float,
+        default=360,
+        help="キューの可視性タイムアウト（秒）。実行係が変更しなかった場合の再配信までの秒数",
+    )
+    parser.add_argument(
+        "--processor-timeout",
+        type=float,
+        default=900000,
+        help="実行係のタイムアウト（ミリ秒）",
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=600,
+        help="キューが空になるまで待つ上限（秒）",
+    )
+    args = parser.parse_args()
+
+    records = load_captures(args.captures)
+    # 受付係と実行係の両方で記録した場合は同じ質問が2回含まれるため、1種類だけを再生する
+    kinds = {record["kind"] for record in records}
+    kind = args.kind or ("apigw" if "apigw" in kinds else "sqs")
+    records = [record for record in records if record["kind"] == kind]
+    if not records:
+        print("No captured events found.")
+        return
+
+    # ハンドラーのログは多いため、結果だけを表示する
+    replayer = Replayer(args)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        report = replayer.run(records)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+##################################################
+# PrAIs-blank.yml（Difyのワークフロー）をローカルで実行し、ノードごとの所要時間を測るツール
+#
+# グラフを読み込み、前のノードがすべて終わったノードから並列に実行します。
+# - HTTPリクエストノード: get_messages / get_reactions はこのリポジトリのハンドラーを同じプロセス内で呼び出し、
+#   それ以外（画像生成・Slackへの投稿）はスタブで応答します
+# - LLMノード: スタブで応答します
+# - コードノード: python3 はそのまま、javascript は node コマンドで実行します
+# スタブは --stubs で指定したPythonファイルの llm() / http() で差し替えられます。
+#
+# 使い方:
+#   python tools/workflow_executor.py
+#   python tools/workflow_executor.py --llm-latency 8000 --http-latency 500 --stub-handlers
+#   python tools/workflow_executor.py --stubs my_stubs.py --json
+##################################################
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import threading
+import importlib.util
+import unicodedata
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 複数の関数で使う共通モジュール（デプロイ時に各関数のディレクトリにコピーされる）
+sys.path.insert(0, os.path.join(ROOT, "common"))
+DEFAULT_WORKFLOW = os.path.join(ROOT, "PrAIs-blank.yml")
+
+# HTTPリクエストノードのURLの末尾と、同じプロセス内で呼び出すLambda関数のディレクトリ
+HANDLER_ROUTES = {
+    "get-messages": "get_messages",
+    "get-reactions": "get_reactions",
+    "get-ractions": "get_reactions",
+}
+
+# 変数の参照（{{#ノードID.変数名#}}）
+VARIABLE_PATTERN = re.compile(r"\{\{#([\w.-]+?)\.([\w.-]+)#\}\}")
+
+STATUS_SUCCEEDED = "succeeded"
+STATUS_FAILED = "failed"
+STATUS_SKIPPED = "skipped"
+
+
+class FakeContext:
+    def __init__(self, timeout_ms, function_name):
+        self.function_name = function_name
+        self._deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
+
+
+class DefaultStubs:
+    """
+    外部サービスの代わりに、指定した遅延の後で決まった応答を返すスタブ
+    """
+
+    def __init__(self, llm_latency_ms, http_latency_ms):
+        self.llm_latency_ms = llm_latency_ms
+        self.http_latency_ms = http_latency_ms
+
+    def llm(self, node, messages):
+        """
+        LLMノードの応答（text）を返します。
+        このワークフローではJSON（message と image_prompt）を返すように指示している。
+        """
+        time.sleep(self.llm_latency_ms / 1000)
+        return json.dumps(
+            {
+                "message": "みんなよく頑張ったのだ。",
+                "image_prompt": "A bouquet of colorful flowers celebrating teamwork",
+            },
+            ensure_ascii=False,
+        )
+
+    def http(self, node, request):
+        """
+        HTTPリクエストノードの応答を (ステータスコード, 本文) で返します。
+        """
+        time.sleep(self.http_latency_ms / 1000)
+        path = urlparse(request["url"]).path.rstrip("/").rsplit("/", 1)[-1]
+        if path in HANDLER_ROUTES:
+            return 200, "[]"
+        if path == "generate":
+            return 200, json.dumps({"s3Url": "https://example.invalid/praise.png"})
+        return 200, json.dumps({"ok": True})
+
+
+def load_stubs(path, defaults):
+    """
+    --stubs で指定したファイルの llm(node, messages) / http(node, request) で既定のスタブを上書きします。
+    """
+    spec = importlib.util.spec_from_file_location("workflow_stubs", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    for name in ("llm", "http"):
+        if hasattr(module, name):
+            setattr(defaults, name, getattr(module, name))
+    return defaults
+
+
+def load_handler(directory):
+    """
+    Lambda関数のディレクトリの app.py を、名前が衝突しないように読み込みます。
+    """
+    path = os.path.join(ROOT, directory)
+    sys.path.insert(0, path)
+    try:
+        spec = importlib.util.spec_from_file_location(
+            f"workflow_{directory}_app", os.path.join(path, "app.py")
+        )
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        sys.path.remove(path)
+
+
+def parse_key_values(text):
+    """
+    Difyのヘッダー・クエリパラメータの書式（1行に1つの key:value）を辞書にします。
+    """
+    result = {}
+    for line in (text or "").splitlines():
+        if ":" in line:
+            key, value = line.split(":", 1)
+            result[key.strip()] = value.strip()
+    return result
+
+
+def load_graph(path):
+    """
+    ワークフローのYAMLからノードと、各ノードの前のノードの一覧を取り出します。
+    メモ（custom-note）はグラフの一部ではないため除きます。
+    """
+    with open(path, encoding="utf-8") as f:
+        graph = yaml.safe_load(f)["workflow"]["graph"]
+
+    nodes = {
+        node["id"]: node["data"]
+        for node in graph["nodes"]
+        if node.get("type") == "custom" and node["data"].get("type")
+    }
+    parents = {node_id: [] for node_id in nodes}
+    for edge in graph["edges"]:
+        if edge["source"] in nodes and edge["target"] in nodes:
+            parents[edge["target"]].append(edge["source"])
+    return nodes, parents
+
+
+class WorkflowExecutor:
+    """
+    ノードを依存関係の順に、独立したものは並列に実行して所要時間を記録します。
+    """
+
+    def __init__(
+        self, nodes, parents, stubs, inputs=None, stub_handlers=False, timeout_ms=900000
+    ):
+        self.nodes = nodes
+        self.parents = parents
+        self.stubs = stubs
+        self.inputs = inputs or {}
+        self.stub_handlers = stub_handlers
+        self.timeout_ms = timeout_ms
+        self.outputs = {}
+        self.timings = {}
+        self._handlers = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, text):
+        """
+        {{#ノードID.変数名#}} を前のノードの出力で置き換えます。
+        """
+
+        def replace(match):
+            value = self.outputs.get(match.group(1), {}).get(match.group(2), "")
+            return (
+                value
+                if isinstance(value, str)
+                else json.dumps(value, ensure_ascii=False)
+            )
+
+        return VARIABLE_PATTERN.sub(replace, text or "")
+
+    def _handler(self, directory):
+        with self._lock:
+            if directory not in self._handlers:
+                self._handlers[directory] = load_handler(directory)
+            return self._handlers[directory]
+
+    def run_start(self, node_id, data):
+        return dict(self.inputs)
+
+    def run_end(self, node_id, data):
+        return {
+            output["variable"]: self.outputs.get(output["value_selector"][0], {}).get(
+                output["value_selector"][1]
+            )
+            for output in data.get("outputs") or []
+        }
+
+    def run_http_request(self, node_id, data):
+        body = data.get("body") or {}
+        request = {
+            "method": data.get("method", "get").upper(),
+            "url": self.resolve(data.get("url")),
+            "headers": parse_key_values(self.resolve(data.get("headers"))),
+            "params": parse_key_values(self.resolve(data.get("params"))),
+            "body": "".join(
+                self.resolve(item.get("value")) for item in body.get("data") or []
+            ),
+        }
+
+        path = urlparse(request["url"]).path.rstrip("/").rsplit("/", 1)[-1]
+        directory = HANDLER_ROUTES.get(path)
+        if directory and not self.stub_handlers:
+            # API Gateway（HTTP API）経由で呼ばれたときと同じ形のイベントで呼び出す
+            response = self._handler(directory).lambda_handler(
+                {
+                    "queryStringParameters": request["params"] or None,
+                    "headers": request["headers"],
+                    "body": request["body"] or None,
+                },
+                FakeContext(self.timeout_ms, directory),
+            )
+            status, response_body = response.get("statusCode", 200), response.get(
+                "body", ""
+            )
+        else:
+            status, response_body = self.stubs.http(data, request)
+        return {"status_code": status, "body": response_body, "headers": {}}
+
+    def run_llm(self, node_id, data):
+        messages = [
+            {"role": message["role"], "text": self.resolve(message["text"])}
+            for message in data.get("prompt_template") or []
+        ]
+        return {"text": self.stubs.llm(data, messages)}
+
+    def run_code(self, node_id, data):
+        args = {
+            variable["variable"]: self.outputs.get(
+                variable["value_selector"][0], {}
+            ).get(variable["value_selector"][1])
+            for variable in data.get("variables") or []
+        }
+        language = data.get("code_language")
+        if language == "python3":
+            namespace = {}
+            exec(data["code"], namespace)
+            return namespace["main"](**args)
+        if language == "javascript":
+            return self._run_javascript(data["code"], args)
+        raise ValueError(f"Unsupported code language: {language}")
+
+    def _run_javascript(self, code, args):
+        if not shutil.which("node"):
+            raise RuntimeError(
+                "node command not found (required for javascript code nodes)"
+            )
+        # console.log は標準エラーに回し、main の戻り値だけを標準出力に書き出す
+        script = (
+            "console.log = (...a) => console.error(...a);\n"
+            + code
+            + "\nprocess.stdout.write(JSON.stringify(main(JSON.parse(process.argv[1]))));\n"
+        )
+        result = subprocess.run(
+            ["node", "-e", script, json.dumps(args)],
+            capture_output=True,
+            text=True,
+            timeout=self.timeout_ms / 1000,
+        )
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip())
+        return json.loads(result.stdout)
+
+    def _run_node(self, node_id, started):
+        data = self.nodes[node_id]
+        runner = getattr(self, "run_" + data["type"].replace("-", "_"), None)
+        begin = time.monotonic()
+        try:
+            if runner is None:
+                raise ValueError(f"Unsupported node type: {data['type']}")
+            outputs = runner(node_id, data)
+            status, error = STATUS_SUCCEEDED, None
+        except Exception as e:
+            outputs, status, error = {}, STATUS_FAILED, str(e)
+        end = time.monotonic()
+        with self._lock:
+            self.outputs[node_id] = outputs or {}
+            self.timings[node_id] = {
+                "start_ms": (begin - started) * 1000,
+                "end_ms": (end - started) * 1000,
+                "duration_ms": (end - begin) * 1000,
+                "status": status,
+                "error": error,
+            }
+
+    def run(self):
+        """
+        すべてのノードを実行し、経過時間（ミリ秒）を返します。
+        失敗したノードの後ろのノードは実行しません（skipped）。
+        """
+        started = time.monotonic()
+        pending = set(self.nodes)
+        running = {}
+        with ThreadPoolExecutor(max_workers=len(self.nodes)) as executor:
+            while pending or running:
+                # スキップしたノードの後ろのノードもスキップできるように、変化がなくなるまで繰り返す
+                progressed = True
+                while progressed:
+                    progressed = False
+                    for node_id in sorted(pending):
+                        parents = self.parents[node_id]
+                        if any(p in pending or p in running.values() for p in parents):
+                            continue
+                        pending.discard(node_id)
+                        progressed = True
+                        if any(
+                            self.timings[p]["status"] != STATUS_SUCCEEDED
+                            for p in parents
+                        ):
+                            now = (time.monotonic() - started) * 1000
+                            self.timings[node_id] = {
+                                "start_ms": now,
+                                "end_ms": now,
+                                "duration_ms": 0.0,
+                                "status": STATUS_SKIPPED,
+                                "error": None,
+                            }
+                            continue
+                        running[executor.submit(self._run_node, node_id, started)] = (
+                            node_id
+                        )
+                if not running:
+                    if pending:
+                        raise ValueError(
+                            f"Workflow graph has a cycle: {sorted(pending)}"
+                        )
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    del running[future]
+        return (time.monotonic() - started) * 1000
+
+    def critical_path(self):
+        """
+        最後に終わったノードから、それぞれ最も遅く終わった前のノードをたどった経路
+        （この経路上のノードが速くならない限り、全体の時間は短くならない）
+        """
+        node_id = max(self.timings, key=lambda n: self.timings[n]["end_ms"])
+        path = [node_id]
+        while self.parents[node_id]:
+            node_id = max(
+                self.parents[node_id], key=lambda n: self.timings[n]["end_ms"]
+            )
+            path.append(node_id)
+        return list(reversed(path))
+
+    def report(self, elapsed_ms):
+        path = self.critical_path()
+        on_path = set(path)
+        nodes = [
+            {
+                "id": node_id,
+                "title": self.nodes[node_id].get("title"),
+                "type": self.nodes[node_id]["type"],
+                "start_ms": round(timing["start_ms"], 1),
+                "duration_ms": round(timing["duration_ms"], 1),
+                "status": timing["status"],
+                "error": timing["error"],
+                "critical": node_id in on_path,
+                "status_code": self.outputs.get(node_id, {}).get("status_code"),
+            }
+            for node_id, timing in sorted(
+                self.timings.items(), key=lambda t: t[1]["start_ms"]
+            )
+        ]
+        path_ms = sum(self.timings[n]["duration_ms"] for n in path)
+        dominant = max(path, key=lambda n: self.timings[n]["duration_ms"])
+        return {
+            "elapsed_ms": round(elapsed_ms, 1),
+            "critical_path": [self.nodes[n].get("title") or n for n in path],
+            "critical_path_ms": round(path_ms, 1),
+            "dominant_node": self.nodes[dominant].get("title") or dominant,
+            "nodes": nodes,
+        }
+
+
+def _pad(text, width):
+    # 日本語のノード名でも列がそろうように、全角文字を2文字分として数える
+    size = sum(2 if unicodedata.east_asian_width(c) in "WF" else 1 for c in text)
+    return text + " " * max(width - size, 0)
+
+
+def print_report(report):
+    print(f"{'node':<24} {'type':<14} {'start(ms)':>10} {'duration(ms)':>13}  status")
+    for node in report["nodes"]:
+        mark = "*" if node["critical"] else " "
+        status = node["status"]
+        if node["status_code"] is not None:
+            status += f" ({node['status_code']})"
+        if node["error"]:
+            status += f": {node['error']}"
+        print(
+            f"{mark}{_pad(node['title'] or node['id'], 23)} {node['type']:<14} "
+            f"{node['start_ms']:>10.1f} {node['duration_ms']:>13.1f}  {status}"
+        )
+    print()
+    print(f"elapsed: {report['elapsed_ms']:.1f} ms")
+    print(
+        f"critical path ({report['critical_path_ms']:.1f} ms): "
+        + " -> ".join(report["critical_path"])
+    )
+    print(f"dominant node: {report['dominant_node']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Difyのワークフローをローカルで実行して所要時間を測定します"
+    )
+    parser.add_argument(
+        "workflow", nargs="?", default=DEFAULT_WORKFLOW, help="ワークフローのYAML"
+    )
+    parser.add_argument(
+        "--stubs", help="llm() / http() を定義したスタブのPythonファイル"
+    )
+    parser.add_argument(
+        "--llm-latency",
+        type=float,
+        default=5000,
+        help="既定のLLMスタブの遅延（ミリ秒）",
+    )
+    parser.add_argument(
+        "--http-latency",
+        type=float,
+        default=1000,
+        help="既定のHTTPスタブの遅延（ミリ秒）",
+    )
+    parser.add_argument(
+        "--stub-handlers",
+        action="store_true",
+        help="get_messages / get_reactions もハンドラーを呼ばずにスタブで応答する",
+    )
+    parser.add_argument(
+        "--input", action="append", default=[], help="開始ノードの入力（key=value）"
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=900000,
+        help="ハンドラーのタイムアウト（ミリ秒）",
+    )
+    parser.add_argument("--json", action="store_true", help="結果をJSONで出力する")
+    args = parser.parse_args()
+
+    stubs = DefaultStubs(args.llm_latency, args.http_latency)
+    if args.stubs:
+        stubs = load_stubs(args.stubs, stubs)
+
+    nodes, parents = load_graph(args.workflow)
+    executor = WorkflowExecutor(
+        nodes,
+        parents,
+        stubs,
+        inputs=dict(item.split("=", 1) for item in args.input),
+        stub_handlers=args.stub_handlers,
+        timeout_ms=args.timeout,
+    )
+
+    # ハンドラーのログは多いため、結果だけを表示する
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        elapsed_ms = executor.run()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    report = executor.report(elapsed_ms)
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()